@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+"""
+    `bench_decision_grid.py`
+
+    Benchmark and accuracy drift report of the `OneClassCUMUL` decision grid
+    against the exact SVM.
+
+        ./benchmarks/bench_decision_grid.py [dataset.libsvm]
+
+    Trains both scorers on the dataset (the CUMUL test data by default) and
+    scores the training samples plus jittered copies of them, one at a time
+    and in a batch. Prints a JSON report with the timings, the fraction of
+    samples that fell back to the exact SVM and the confidence drift.
+"""
+import sys
+import json
+import timeit
+import numpy as np
+
+from os.path import join, abspath, dirname, pardir
+
+from sklearn.datasets import load_svmlight_file
+
+BASE_DIR = abspath(join(dirname(__file__), pardir))
+# run from a checkout: import the onionpop next to this directory
+sys.path.insert(0, BASE_DIR)
+
+from onionpop.classifiers import OneClassCUMUL
+
+DATA_DIR = join(BASE_DIR, 'test', 'data')
+SVM_PARAMS = {"kernel": "rbf", "gamma": 0.5}
+
+
+def _per_sample_seconds(fn, samples, repeat=3):
+    return min(timeit.repeat(lambda: [fn(s) for s in samples], number=1, repeat=repeat)) / len(samples)
+
+
+def run(dataset, num_single=200, seed=0):
+    X, y = load_svmlight_file(dataset)
+    X = np.asarray(X.todense())
+
+    exact = OneClassCUMUL(**SVM_PARAMS)
+    exact.train(X, y)
+    start = timeit.default_timer()
+    fast = OneClassCUMUL(decision_grid=True, **SVM_PARAMS)
+    fast.train(X, y)
+    train_seconds = timeit.default_timer() - start  # SVM fit and grid build
+
+    # training samples plus jittered copies of them
+    rng = np.random.RandomState(seed)
+    jittered = X * rng.normal(1.0, 0.05, size=X.shape)
+    samples = np.vstack([X, jittered])
+
+    exact_pred, exact_conf = exact.predict_many_with_confidence(samples)
+    fast_pred, fast_conf = fast.predict_many_with_confidence(samples)
+    interpolated, error_bound = fast.grid.interpolate(fast.scaler.transform(samples[:, [5, 90]]))
+    drift = np.abs(fast_conf - exact_conf)
+
+    single = samples[:num_single]
+    report = {
+        'dataset': dataset,
+        'num_samples': len(samples),
+        'num_support_vectors': len(exact._clf.support_vectors_),
+        'grid_resolution': fast.grid.resolution,
+        'grid_max_error': fast.grid_max_error,
+        'grid_train_seconds': train_seconds,
+        'fallback_fraction': float(np.mean(np.abs(interpolated) <= error_bound)),
+        'predictions_identical': bool(np.array_equal(exact_pred, fast_pred)),
+        'confidence_drift_max': float(drift.max()),
+        'confidence_drift_mean': float(drift.mean()),
+        'exact_single_seconds': _per_sample_seconds(exact.predict_with_confidence, single),
+        'grid_single_seconds': _per_sample_seconds(fast.predict_with_confidence, single),
+        'exact_batch_seconds': min(timeit.repeat(
+            lambda: exact.predict_many_with_confidence(samples), number=1, repeat=3)) / len(samples),
+        'grid_batch_seconds': min(timeit.repeat(
+            lambda: fast.predict_many_with_confidence(samples), number=1, repeat=3)) / len(samples),
+    }
+    return report
+
+
+if __name__ == "__main__":
+    dataset = sys.argv[1] if len(sys.argv) > 1 else join(DATA_DIR, 'cumul_training.libsvm')
+    print(json.dumps(run(dataset), indent=2, sort_keys=True))
@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+"""
+    `bench_startup.py`
+
+    Startup benchmark of the onionpop API, as paid by every PrivCount worker.
+
+        ./benchmarks/bench_startup.py [-n runs]
+
+    Measures, in fresh interpreters:
+        - the time of `import onionpop.pipeline`
+        - the time from interpreter start to the first prediction with a
+          model stored in the pickle-free format (`MiddleEarthModel.save`)
+    and lists the heavy modules that each step imported. Prints a JSON
+    report with the median of the runs.
+"""
+import sys
+import json
+import shutil
+import argparse
+import tempfile
+import subprocess
+import numpy as np
+
+from os.path import join, abspath, dirname, pardir
+
+BASE_DIR = abspath(join(dirname(__file__), pardir))
+# run from a checkout: import the onionpop next to this directory
+sys.path.insert(0, BASE_DIR)
+
+HEAVY_MODULES = ['dill', 'pandas', 'scipy', 'sklearn', 'pyborist']
+
+IMPORT_SNIPPET = """
+import sys, json, time
+start = time.time()
+import onionpop.pipeline
+elapsed = time.time() - start
+print(json.dumps({'seconds': elapsed, 'modules': [m for m in %r if m in sys.modules]}))
+"""
+
+PREDICT_SNIPPET = """
+import sys, json, time
+start = time.time()
+from onionpop.pipeline import MiddleEarthModel
+from onionpop.features import Features
+from onionpop.fixtures import make_test_circuit
+model = MiddleEarthModel.load(%r)
+model.predict(Features(make_test_circuit()))
+elapsed = time.time() - start
+print(json.dumps({'seconds': elapsed, 'modules': [m for m in %r if m in sys.modules]}))
+"""
+
+
+def _build_model(dirpath):
+    """Train a small pipeline on random data and save it."""
+    from onionpop.pipeline import MiddleEarthModel, Model
+
+    rng = np.random.RandomState(0)
+    model = MiddleEarthModel()
+    for classifier, params, num_features in [
+            ('PurposeClassifier', {'backend': 'sklearn', 'n_estimators': 30}, 22),
+            ('PositionClassifier', {'backend': 'sklearn', 'n_estimators': 30}, 22),
+            ('OneClassCUMUL', {'kernel': 'rbf', 'gamma': 0.5}, 104)]:
+        m = Model({'dataset': None, 'classifier': classifier, 'params': params})
+        X = rng.randint(0, 20, size=(500, num_features)).astype(float)
+        m._clf.train(X, (X[:, 0] > 5).astype(int))
+        model.add(m)
+    model.save(dirpath)
+
+
+def _run(snippet, runs):
+    # the snippets import onionpop from the current directory first
+    results = [json.loads(subprocess.check_output([sys.executable, '-c', snippet], cwd=BASE_DIR).decode())
+               for _ in range(runs)]
+    return {'median_seconds': float(np.median([r['seconds'] for r in results])),
+            'heavy_modules': results[-1]['modules']}
+
+
+def run(runs=5):
+    tmpdir = tempfile.mkdtemp()
+    try:
+        model_dir = join(tmpdir, 'model')
+        _build_model(model_dir)
+        return {'runs': runs,
+                'import_pipeline': _run(IMPORT_SNIPPET % HEAVY_MODULES, runs),
+                'first_prediction': _run(PREDICT_SNIPPET % (model_dir, HEAVY_MODULES), runs)}
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Startup benchmark of the onionpop API.")
+    parser.add_argument('-n', '--runs', type=int, default=5, help='number of fresh interpreters per measure.')
+    args = parser.parse_args()
+    print(json.dumps(run(args.runs), indent=2, sort_keys=True))
@@ -0,0 +1,94 @@
+"""
+    `generator.py`
+
+    Seeded generator of synthetic Tor circuits, as seen from a middle relay.
+
+    Circuits start with a CREATE/CREATED handshake followed by the EXTEND
+    handshakes of the next hops, and then carry RELAY cells whose commands
+    are encrypted (UNKNOWN at the middle). Every logical cell is received on
+    one side of the relay and sent on the other shortly after. Onion service
+    (HS) circuits have more extend handshakes and a more balanced traffic
+    pattern than general circuits, which are download-heavy.
+
+        gen = CircuitGenerator(seed=0)
+        circuits = gen.workload(1000, hs_fraction=0.2, long_fraction=0.1)
+"""
+import random
+
+from onionpop.features import Node, Cell, Circuit
+
+SHORT_CELLS = (20, 200)
+LONG_CELLS = (2000, 6000)
+
+
+class CircuitGenerator(object):
+
+    def __init__(self, seed=0):
+        self.rng = random.Random(seed)
+        self._next_circ_id = 0
+
+    def node(self):
+        rng = self.rng
+        return Node('R{}'.format(rng.randint(0, 9999)), '10.0.0.1', '0000',
+                    rng.random() < 0.9, rng.random() < 0.2, rng.random() < 0.4)
+
+    def circuit(self, num_cells, is_hs=False):
+        """Return a circuit with about `num_cells` cells."""
+        rng = self.rng
+        chan_id = rng.randint(0, 2 ** 16)
+        circ_id = self._next_circ_id
+        self._next_circ_id += 1
+        circuit = Circuit(chan_id, circ_id, self.node(), self.node())
+
+        timestamp = rng.uniform(0, 86400)
+        cells = []
+
+        def relay(forward, ctype, command):
+            cells.append((forward, ctype, command))
+
+        # create handshake with the previous hop
+        create = rng.choice([('CREATE2', 'CREATED2'), ('CREATE', 'CREATED'), ('CREATE_FAST', 'CREATED_FAST')])
+        relay(True, create[0], 'UNKNOWN')
+        relay(False, create[1], 'UNKNOWN')
+
+        # extend handshakes to the next hops
+        num_extends = rng.randint(2, 4) if is_hs else rng.randint(1, 2)
+        for _ in range(num_extends):
+            relay(True, 'RELAY_EARLY', 'UNKNOWN')
+            relay(False, 'RELAY', 'UNKNOWN')
+
+        # data phase: HS circuits are more balanced
+        forward_ratio = 0.4 if is_hs else 0.15
+        while len(cells) * 2 < num_cells:
+            relay(rng.random() < forward_ratio, 'RELAY', 'UNKNOWN')
+
+        relay(True, 'DESTROY', 'UNKNOWN')
+
+        for forward, ctype, command in cells:
+            # bursty inter-arrival times
+            timestamp += rng.expovariate(50.0) if rng.random() < 0.9 else rng.expovariate(1.0)
+            # received on one side, then sent on the other
+            circuit.add_cell(Cell(chan_id, circ_id, timestamp, ctype, command, False, forward))
+            timestamp += rng.expovariate(5000.0)
+            circuit.add_cell(Cell(chan_id, circ_id, timestamp, ctype, command, True, forward))
+
+        return circuit
+
+    def workload(self, num_circuits, hs_fraction=0.2, long_fraction=0.1):
+        """Return `(circuits, is_hs)` for a mix of HS and general circuits
+        of short and multi-thousand-cell lengths.
+        """
+        circuits = []
+        is_hs = []
+        for _ in range(num_circuits):
+            hs = self.rng.random() < hs_fraction
+            low, high = LONG_CELLS if self.rng.random() < long_fraction else SHORT_CELLS
+            circuits.append(self.circuit(self.rng.randint(low, high), is_hs=hs))
+            is_hs.append(hs)
+        return circuits, is_hs
+
+
+def trace_lines(circuit):
+    """Client-side cells of a circuit as k-FP "<timestamp>\t<direction>" lines."""
+    from onionpop.features import Features
+    return ['{!r}\t{}'.format(t, d) for t, d in Features(circuit).get_cell_sequence()]
@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+"""
+    `run.py`
+
+    Benchmark suite of the feature extraction and classification code on
+    synthetic circuits (see `generator.py`).
+
+        ./benchmarks/run.py -o results.json
+        ./benchmarks/run.py -o new.json --compare results.json
+
+    Every benchmark is run on four workloads (short/long x general/HS
+    circuits) and reports the best per-circuit time over the repeats. The
+    results are written as JSON together with the commit and library
+    versions, so that they can be compared between commits with `--compare`.
+"""
+import sys
+import json
+import timeit
+import argparse
+import platform
+import subprocess
+import numpy as np
+
+from os.path import dirname, abspath, join, pardir
+
+# run from a checkout: import the onionpop next to this directory
+sys.path.insert(0, abspath(join(dirname(__file__), pardir)))
+
+import onionpop.cumul
+import onionpop.kfp
+from onionpop.features import Features
+from onionpop.pipeline import MiddleEarthModel, Model
+
+from generator import CircuitGenerator, trace_lines, SHORT_CELLS, LONG_CELLS
+
+WORKLOADS = [
+    ('short_general', SHORT_CELLS, False),
+    ('short_hs', SHORT_CELLS, True),
+    ('long_general', LONG_CELLS, False),
+    ('long_hs', LONG_CELLS, True),
+]
+
+
+def _per_call(fn, items, repeat):
+    """Best time per item of `fn` applied to every item."""
+    return min(timeit.repeat(lambda: [fn(item) for item in items], number=1, repeat=repeat)) / len(items)
+
+
+def _per_batch_item(fn, items, repeat):
+    """Best time per item of `fn` applied to all the items at once."""
+    return min(timeit.repeat(lambda: fn(items), number=1, repeat=repeat)) / len(items)
+
+
+def train_model(gen, num_circuits=300):
+    """Train a small pipeline on synthetic circuits."""
+    circuits, is_hs = gen.workload(num_circuits, hs_fraction=0.5, long_fraction=0.0)
+    features = [Features(c) for c in circuits]
+    circuit_X = np.array([f.extract_purpose_features() for f in features], dtype=float)
+    webfp_X = np.array([f.extract_webfp_features() for f in features])
+    labels = np.array(is_hs, dtype=int)
+
+    model = MiddleEarthModel()
+    for classifier, params, X in [
+            ('PurposeClassifier', {'backend': 'sklearn', 'n_estimators': 30, 'random_state': 0}, circuit_X),
+            ('PositionClassifier', {'backend': 'sklearn', 'n_estimators': 30, 'random_state': 0}, circuit_X),
+            ('OneClassCUMUL', {'kernel': 'rbf', 'gamma': 0.5}, webfp_X)]:
+        m = Model({'dataset': None, 'classifier': classifier, 'params': params})
+        m._clf.train(X, labels)
+        model.add(m)
+    return model
+
+
+def run_workload(model, circuits, repeat):
+    results = {}
+    lines = [trace_lines(c) for c in circuits]
+
+    # feature extraction, on fresh Features objects so that nothing is cached
+    results['features.purpose'] = _per_call(
+        lambda c: Features(c).extract_purpose_features(), circuits, repeat)
+    results['features.webfp'] = _per_call(
+        lambda c: Features(c).extract_webfp_features(), circuits, repeat)
+    results['cumul.extract'] = _per_call(
+        lambda c: onionpop.cumul.extract(Features(c).get_cell_sequence()), circuits, repeat)
+    results['kfp.extract.lines'] = _per_call(onionpop.kfp.extract, lines, repeat)
+    results['kfp.extract.circuit'] = _per_call(onionpop.kfp.extract, circuits, repeat)
+
+    # classifiers, on precomputed feature vectors
+    features = [Features(c) for c in circuits]
+    for m in model._models:
+        clf = m._clf
+        vectors = [clf.extract_features(f) for f in features]
+        name = type(clf).__name__
+        results['{}.predict_with_confidence'.format(name)] = _per_call(
+            clf.predict_with_confidence, vectors, repeat)
+        results['{}.predict_many_with_confidence'.format(name)] = _per_batch_item(
+            clf.predict_many_with_confidence, np.asarray(vectors), repeat)
+
+    # whole pipeline, features included
+    results['MiddleEarthModel.predict'] = _per_call(
+        lambda c: model.predict(Features(c)), circuits, repeat)
+    results['MiddleEarthModel.predict_many'] = _per_batch_item(
+        lambda cs: model.predict_many([Features(c) for c in cs]), circuits, repeat)
+
+    return results
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=dirname(abspath(__file__)),
+                                       stderr=subprocess.STDOUT).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(seed=0, num_circuits=50, repeat=3):
+    import sklearn
+
+    gen = CircuitGenerator(seed)
+    model = train_model(gen)
+
+    report = {
+        'meta': {
+            'commit': _git_commit(),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'sklearn': sklearn.__version__,
+            'seed': seed,
+            'num_circuits': num_circuits,
+            'repeat': repeat,
+            'unit': 'seconds per circuit',
+        },
+        'results': {},
+    }
+    for name, (low, high), is_hs in WORKLOADS:
+        circuits = [gen.circuit(gen.rng.randint(low, high), is_hs=is_hs) for _ in range(num_circuits)]
+        report['results'][name] = run_workload(model, circuits, repeat)
+    return report
+
+
+def compare(new, old):
+    """Return the new/old time ratio of every benchmark present in both."""
+    ratios = {}
+    for workload, results in new['results'].items():
+        for name, seconds in results.items():
+            old_seconds = old['results'].get(workload, {}).get(name)
+            if old_seconds:
+                ratios['{}/{}'.format(workload, name)] = seconds / old_seconds
+    return ratios
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark suite on synthetic circuits.",
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-o', '--output', type=str, help='path of the JSON results (stdout by default).')
+    parser.add_argument('-s', '--seed', type=int, default=0, help='seed of the circuit generator.')
+    parser.add_argument('-n', '--circuits', type=int, default=50, help='circuits per workload.')
+    parser.add_argument('-r', '--repeat', type=int, default=3, help='repetitions of every benchmark.')
+    parser.add_argument('--compare', type=str, metavar='<results.json>',
+                        help='previous results to compare with (prints new/old time ratios).')
+    args = parser.parse_args()
+
+    report = run(seed=args.seed, num_circuits=args.circuits, repeat=args.repeat)
+    if args.compare:
+        with open(args.compare) as fi:
+            report['ratios'] = compare(report, json.load(fi))
+
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as fo:
+            fo.write(output)
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
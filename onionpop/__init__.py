@@ -1,7 +1,19 @@
 __all__ = [
    'classifiers',
    'cumul',
+   'decision_grid',
+   'feature_cache',
    'features',
+   'fixtures',
+   'forest',
+   'instrumentation',
    'kfp',
+   'knn',
    'pipeline',
+   'registry',
+   'scheduler',
+   'storage',
+   'streaming',
+   'traces',
+   'worker',
 ]
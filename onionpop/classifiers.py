@@ -2,31 +2,75 @@
     `classifiers.py`
 
     This module implements the classifiers to be used in the pipeline.
+
+    scikit-learn and Pyborist are only imported when a classifier is
+    instantiated for training, so that trained models that do not need them
+    (see `onionpop.storage`) can be loaded and used without paying for their
+    import.
 """
 
 # classifiers
+import threading
 import numpy as np
-from sklearn import svm
-from sklearn.preprocessing import scale
-from pyborist import PyboristClassifier
-from sklearn.preprocessing import StandardScaler
+
+from collections import OrderedDict
 from onionpop.features import Features
+from onionpop.forest import FlatForest
+from onionpop.decision_grid import DecisionGrid, RBFDecisionFunction
 
 
 class ClassifierInterface(object):
 
     _clf = None
+    # whether `train` takes scipy sparse matrices
+    accepts_sparse = False
+    # whether the confidence is always 1.0, so that the adaptive scheduler
+    # may evaluate the classifier before the stages that precede it
+    reorderable = False
 
     def predict(self, features):
         feature_vector = self.extract_features(features)
         return self.predict_with_confidence(feature_vector)
 
+    def predict_many(self, features_list):
+        """Batch version of `predict`.
+
+        Parameters
+        ----------
+        features_list : list of Features
+            One `Features` object per circuit.
+
+        Output
+        ------
+            predictions, confidences : tup (np.array of bool, np.array of float)
+                One entry per circuit, in the same order as `features_list`.
+        """
+        feature_matrix = self.extract_feature_matrix(features_list)
+        return self.predict_many_with_confidence(feature_matrix)
+
     def extract_features(self, features):
         """Template method that must be implemented in each specific
         classifier.
         """
         pass
 
+    def extract_feature_matrix(self, features_list):
+        """Stack the feature vectors of several circuits into a 2-D matrix."""
+        return np.asarray([self.extract_features(f) for f in features_list])
+
+    def predict_with_confidence(self, feature_vector):
+        fv = np.asarray(feature_vector)
+        fv = fv.reshape(1, -1) # we have a single sample
+        predictions, confidences = self.predict_many_with_confidence(fv)
+        return (bool(predictions[0]), float(confidences[0]))
+
+    def predict_many_with_confidence(self, feature_matrix):
+        """Template method that must be implemented in each specific
+        classifier. Returns one prediction and one confidence per row of
+        `feature_matrix`.
+        """
+        pass
+
     def train(self, features, labels):
         """Train the model.
 
@@ -40,9 +84,45 @@ class ClassifierInterface(object):
 
         self._clf.fit(features, labels)
 
+    def set_n_jobs(self, n_jobs):
+        """Let the underlying classifier train with `n_jobs` parallel jobs,
+        if it supports it.
+        """
+        pass
+
+    def get_state(self):
+        """Return `(params, arrays)` describing the trained classifier, where
+        `params` is JSON-serializable and `arrays` maps names to numpy arrays.
+
+        Used to store models without pickling (see `onionpop.storage`).
+        """
+        raise ValueError("{} cannot be stored without pickling.".format(type(self).__name__))
+
+    @classmethod
+    def from_state(cls, params, arrays):
+        """Rebuild a trained classifier from the output of `get_state`."""
+        raise ValueError("{} cannot be loaded without pickling.".format(cls.__name__))
+
 
 class OneClassCUMUL(ClassifierInterface):
+    """One-class SVM on CUMUL features 5 and 90.
+
+    With `"decision_grid": true` in the params, a `DecisionGrid` of the
+    decision function is built at training time and used to score samples.
+    Predictions stay exact and the confidence is within `grid_max_error` of
+    the exact distance (see `onionpop.decision_grid`).
+    """
+    grid = None
+    # numpy decision function of models loaded without the sklearn SVM
+    decision_function = None
+
     def __init__(self, *args, **params):
+        from sklearn import svm
+        from sklearn.preprocessing import StandardScaler
+
+        self.use_decision_grid = params.pop('decision_grid', False)
+        self.grid_max_error = params.pop('grid_max_error', 1e-3)
+        self.grid = None
         self.scaler = StandardScaler()
         self._clf = svm.OneClassSVM(**params)
         super(OneClassCUMUL, self).__init__()
@@ -50,13 +130,20 @@ class OneClassCUMUL(ClassifierInterface):
     def extract_features(self, features):
         return features.extract_webfp_features()
 
+    # only two columns are used, and they are densified after selection
+    accepts_sparse = True
+
     def train(self, features, labels):
         """One-class learning: ignores features."""
         features = features[:, [5, 90]]
+        if hasattr(features, 'toarray'):
+            features = features.toarray()
         features = self.scaler.fit_transform(features)
         self._clf.fit(features)
+        if self.use_decision_grid:
+            self.grid = DecisionGrid.from_svm(self._clf, features, max_error=self.grid_max_error)
 
-    def predict_with_confidence(self, feature_vector):
+    def predict_many_with_confidence(self, feature_matrix):
         '''
         Instead of a probability, the confidence is measured as the distance
         of the test sample to the Support Vector:
@@ -69,55 +156,303 @@ class OneClassCUMUL(ClassifierInterface):
             https://stackoverflow.com/questions/15111408/how-does-sklearn-svm-svcs-function-predict-proba-work-internally
 
         '''
-        fv = np.asarray(feature_vector)
-        fv = fv[[5, 90]]
-        fv = fv.reshape(1, -1) # we have a single sample
-        fv = self.scaler.transform(fv)
-        sv_dist = np.asscalar(self._clf.decision_function(fv))
-        prediction = np.asscalar(self._clf.predict(fv))
-        is_fb = False
-        if prediction == 1:
-            is_fb = True
+        fm = np.asarray(feature_matrix)
+        if len(fm) == 0:
+            return np.zeros(0, dtype=bool), np.zeros(0)
+        fm = fm[:, [5, 90]]
+        # same arithmetic as `StandardScaler.transform`, without its
+        # per-call input validation
+        fm = (fm - self.scaler.mean_) / self.scaler.scale_
+        if self.grid is not None:
+            return self._predict_with_grid(fm)
+        return self._predict_exact(fm)
+
+    def _predict_exact(self, fm):
+        if self._clf is None:
+            sv_dist = self.decision_function(fm)
+            # libsvm predicts the positive class for positive decision values
+            return (sv_dist > 0, sv_dist)
+        sv_dist = np.ravel(self._clf.decision_function(fm))
+        prediction = np.ravel(self._clf.predict(fm))
+        is_fb = prediction == 1
+        return (is_fb, sv_dist)
+
+    def _predict_with_grid(self, fm):
+        sv_dist, error_bound = self.grid.interpolate(fm)
+        # the sign is certain when the value is further than the error from 0
+        uncertain = np.abs(sv_dist) <= error_bound
+        is_fb = sv_dist > 0
+        if uncertain.any():
+            is_fb[uncertain], sv_dist[uncertain] = self._predict_exact(fm[uncertain])
         return (is_fb, sv_dist)
 
+    def get_state(self):
+        if self._clf is not None:
+            decision_function = RBFDecisionFunction.from_svm(self._clf)
+        else:
+            decision_function = self.decision_function
+        params, arrays = {}, {}
+        params['svm'], svm_arrays = decision_function.get_state()
+        arrays.update(('svm.' + k, v) for k, v in svm_arrays.items())
+        arrays['scaler.mean'] = self.scaler.mean_
+        arrays['scaler.scale'] = self.scaler.scale_
+        if self.grid is not None:
+            params['grid'], grid_arrays = self.grid.get_state()
+            arrays.update(('grid.' + k, v) for k, v in grid_arrays.items())
+        return params, arrays
+
+    @classmethod
+    def from_state(cls, params, arrays):
+        clf = cls.__new__(cls)
+        clf._clf = None
+        clf.use_decision_grid = 'grid' in params
+        clf.decision_function = RBFDecisionFunction.from_state(params['svm'], _sub_arrays(arrays, 'svm.'))
+        clf.scaler = _FittedScaler(arrays['scaler.mean'], arrays['scaler.scale'])
+        if clf.use_decision_grid:
+            clf.grid = DecisionGrid.from_state(params['grid'], _sub_arrays(arrays, 'grid.'))
+            clf.grid_max_error = clf.grid.max_error
+        return clf
+
+
+class ForestClassifierInterface(ClassifierInterface):
+    """Random forest classifier trained with Pyborist (default) or
+    scikit-learn (`backend="sklearn"` in the params).
+
+    After training, the forest is flattened into a `FlatForest` when the
+    backend exposes its trees, and predictions use the flattened forest.
+    `compile` drops the backend estimator so that the model can be used
+    without the training library.
+
+    The purpose and position features are small counts, and many circuits
+    have the same feature vector, so the predicted labels are memoized in
+    an LRU cache of `cache_size` vectors (0 disables it).
+    """
+
+    forest = None
+    backend = 'pyborist'
+    cache_size = 4096
+    cache_hits = 0
+    cache_misses = 0
+    _cache = None
 
-class PositionClassifier(ClassifierInterface):
     def __init__(self, *args, **params):
-        self._clf = PyboristClassifier(**params)
-        super(PositionClassifier, self).__init__()
+        self.backend = params.pop('backend', self.backend)
+        self.cache_size = params.pop('cache_size', self.cache_size)
+        if self.backend == 'sklearn':
+            from sklearn.ensemble import RandomForestClassifier
+            self._clf = RandomForestClassifier(**params)
+        elif self.backend == 'pyborist':
+            from pyborist import PyboristClassifier
+            self._clf = PyboristClassifier(**params)
+        else:
+            raise ValueError("Unknown random forest backend: {}".format(self.backend))
+        self.forest = None
+        self._cache = None
+        self._cache_lock = threading.Lock()
+        super(ForestClassifierInterface, self).__init__()
+
+    @property
+    def accepts_sparse(self):
+        return self.backend == 'sklearn'
+
+    def set_n_jobs(self, n_jobs):
+        # Pyborist does not take a number of threads
+        if self.backend == 'sklearn':
+            self._clf.set_params(n_jobs=n_jobs)
+
+    def train(self, features, labels):
+        self.clear_cache()
+        self._clf.fit(features, labels)
+        try:
+            self.forest = FlatForest.from_estimator(self._clf)
+        except ValueError:
+            self.forest = None
+
+    def compile(self):
+        """Keep only the flattened forest for prediction."""
+        if self.forest is None:
+            self.forest = FlatForest.from_estimator(self._clf)
+        self._clf = None
+
+    def get_state(self):
+        if self.forest is None:
+            raise ValueError("The {} forest cannot be flattened, train it with the "
+                             "sklearn backend.".format(type(self).__name__))
+        params, arrays = self.forest.get_state()
+        return ({'forest': params, 'cache_size': self.cache_size},
+                dict(('forest.' + k, v) for k, v in arrays.items()))
+
+    @classmethod
+    def from_state(cls, params, arrays):
+        clf = cls.__new__(cls)
+        clf._clf = None
+        clf.forest = FlatForest.from_state(params['forest'], _sub_arrays(arrays, 'forest.'))
+        clf.cache_size = params.get('cache_size', cls.cache_size)
+        clf._cache = None
+        clf._cache_lock = threading.Lock()
+        return clf
+
+    def predict_labels(self, feature_matrix):
+        if not self.cache_size:
+            return self._predict_labels(feature_matrix)
+
+        cache = self._cache
+        if cache is None:
+            with self._cache_lock:
+                if self._cache is None:
+                    self._cache = OrderedDict()
+                cache = self._cache
+
+        feature_matrix = np.asarray(feature_matrix)
+        keys = [tuple(row) for row in feature_matrix.tolist()]
+        labels = [None] * len(keys)
+        missing = []
+        with self._cache_lock:
+            for i, key in enumerate(keys):
+                label = cache.pop(key, None)
+                if label is None:
+                    missing.append(i)
+                else:
+                    cache[key] = label  # most recently used last
+                    labels[i] = label
+            self.cache_hits += len(keys) - len(missing)
+            self.cache_misses += len(missing)
+
+        if missing:
+            computed = self._predict_labels(feature_matrix[missing]).tolist()
+            with self._cache_lock:
+                for i, label in zip(missing, computed):
+                    labels[i] = label
+                    cache[keys[i]] = label
+                while len(cache) > self.cache_size:
+                    cache.popitem(last=False)
+
+        return np.array(labels)
+
+    def predict_proba(self, feature_matrix):
+        """Class probabilities, with columns in the order of `classes`."""
+        if self.forest is not None:
+            return self.forest.predict_proba(feature_matrix)
+        return self._clf.predict_proba(feature_matrix)
+
+    @property
+    def classes(self):
+        if self.forest is not None:
+            return self.forest.classes
+        return self._clf.classes_
+
+    def _predict_labels(self, feature_matrix):
+        if self.forest is not None:
+            return self.forest.predict(feature_matrix)
+        return np.ravel(self._clf.predict(feature_matrix))
+
+    def cache_stats(self):
+        """Hits, misses and size of the prediction cache."""
+        lookups = self.cache_hits + self.cache_misses
+        return {'hits': self.cache_hits, 'misses': self.cache_misses,
+                'hit_rate': float(self.cache_hits) / lookups if lookups else 0.0,
+                'size': len(self._cache) if self._cache is not None else 0,
+                'max_size': self.cache_size}
+
+    def clear_cache(self):
+        with self._cache_lock:
+            self._cache = None
+            self.cache_hits = 0
+            self.cache_misses = 0
+
+    def __getstate__(self):
+        # the cache and its lock are not pickled
+        state = self.__dict__.copy()
+        state.pop('_cache', None)
+        state.pop('_cache_lock', None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._cache = None
+        self._cache_lock = threading.Lock()
+
+
+class PositionClassifier(ForestClassifierInterface):
+    reorderable = True
 
     def extract_features(self, features):
         return features.extract_position_features()
 
-    def predict_with_confidence(self, feature_vector):
-        fv = np.asarray(feature_vector)
-        fv = fv.reshape(1, -1) # we have a single sample
-        fv = fv.astype(np.float)
+    def predict_many_with_confidence(self, feature_matrix):
+        fm = np.asarray(feature_matrix)
+        if len(fm) == 0:
+            return np.zeros(0, dtype=bool), np.zeros(0)
+        fm = fm.astype(float)
 
-        prediction = self._clf.predict(fv)
+        prediction = self.predict_labels(fm)
 
-        is_cgm_pos = True if np.asscalar(prediction) == 1 else False
-        confidence = 1.0 # TODO this needs updating, but its not currently used by PrivCount
+        is_cgm_pos = prediction == 1
+        confidence = np.ones(len(fm)) # TODO this needs updating, but its not currently used by PrivCount
 
         return (is_cgm_pos, confidence)
 
 
-class PurposeClassifier(ClassifierInterface):
-    def __init__(self, *args, **params):
-        self._clf = PyboristClassifier(**params)
-        super(PurposeClassifier, self).__init__()
+class PurposeClassifier(ForestClassifierInterface):
+    reorderable = True
 
     def extract_features(self, features):
         return features.extract_purpose_features()
 
-    def predict_with_confidence(self, feature_vector):
-        fv = np.asarray(feature_vector)
-        fv = fv.reshape(1, -1) # we have a single sample
-        fv = fv.astype(np.float)
+    def predict_many_with_confidence(self, feature_matrix):
+        fm = np.asarray(feature_matrix)
+        if len(fm) == 0:
+            return np.zeros(0, dtype=bool), np.zeros(0)
+        fm = fm.astype(float)
 
-        prediction = self._clf.predict(fv)
+        prediction = self.predict_labels(fm)
 
-        is_rend_purp = True if np.asscalar(prediction) == 1 else False
-        confidence = 1.0 # TODO this needs updating, but its not currently used by PrivCount
+        is_rend_purp = prediction == 1
+        confidence = np.ones(len(fm)) # TODO this needs updating, but its not currently used by PrivCount
 
         return (is_rend_purp, confidence)
+
+
+class KFPClassifier(ForestClassifierInterface):
+    """Random forest on k-FP features (see `onionpop.kfp`), as a website
+    detector. Trained with scikit-learn by default, like the original k-FP.
+
+    The confidence is the fraction of trees voting for the positive class.
+    """
+    backend = 'sklearn'
+    # k-FP vectors are timing statistics and almost never repeat
+    cache_size = 0
+
+    def extract_features(self, features):
+        return features.extract_kfp_features()
+
+    def predict_many_with_confidence(self, feature_matrix):
+        fm = np.asarray(feature_matrix)
+        if len(fm) == 0:
+            return np.zeros(0, dtype=bool), np.zeros(0)
+        fm = fm.astype(float)
+
+        proba = self.predict_proba(fm)
+        classes = np.asarray(self.classes)
+        prediction = classes[np.argmax(proba, axis=1)]
+
+        is_site = prediction == 1
+        if np.any(classes == 1):
+            confidence = proba[:, np.flatnonzero(classes == 1)[0]]
+        else:
+            confidence = np.zeros(len(fm))
+
+        return (is_site, confidence)
+
+
+class _FittedScaler(object):
+    """Parameters of a fitted `StandardScaler`, for loaded models."""
+
+    def __init__(self, mean, scale):
+        self.mean_ = mean
+        self.scale_ = scale
+
+
+def _sub_arrays(arrays, prefix):
+    """Return the arrays whose name starts with `prefix`, without it."""
+    return dict((k[len(prefix):], v) for k, v in arrays.items() if k.startswith(prefix))
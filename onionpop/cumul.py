@@ -6,68 +6,84 @@
 # Outlier Removal should be done beforehand (!)
 
 import numpy as np
-from itertools import islice
+
+
+def _packet_sizes(instance):
+    """Return the packet sizes of a trace given as (timestamp, size) pairs."""
+    if isinstance(instance, np.ndarray):
+        return instance[:, 1]
+    return np.array([packetsize for _, packetsize in instance])
 
 
 def extract(instance, num_interpolation_points=100):
+    return extract_sizes(_packet_sizes(instance), num_interpolation_points)
+
+
+def extract_sizes(packet_sizes, num_interpolation_points=100):
+    """CUMUL features of a trace given as an array of signed packet sizes.
+
+    Positive sizes are incoming packets, negative sizes outgoing packets and
+    zero-sized entries are ignored.
+    """
+    sizes = np.asarray(packet_sizes)
+    sizes = sizes[sizes != 0]
+    incoming = sizes[sizes > 0]
+    outgoing = sizes[sizes < 0]
+
     features = []
+    features.append(len(incoming))  # inCount
+    features.append(len(outgoing))  # outCount
+    features.append(np.abs(outgoing).sum().item())  # outSize
+    features.append(incoming.sum().item())  # inSize
 
-    total = []
-    cum = []
-    pos = []
-    neg = []
-    inSize = 0
-    outSize = 0
-    inCount = 0
-    outCount = 0
-
-    # Process trace
-    for _, packetsize in instance:
-        #f2 = p.strip().split('\t')[1]
-        #if f2 == 'None':
-        #    continue
-        #packetsize = int(f2)
-
-        # incoming packets
-        if packetsize > 0:
-            inSize += packetsize
-            inCount += 1
-
-            # cumulated packetsizes
-            if len(cum) == 0:
-                cum.append(packetsize)
-                total.append(packetsize)
-                pos.append(packetsize)
-                neg.append(0)
-            else:
-                cum.append(cum[-1] + packetsize)
-                total.append(total[-1] + abs(packetsize))
-                pos.append(pos[-1] + packetsize)
-                neg.append(neg[-1] + 0)
-
-        # outgoing packets
-        if packetsize < 0:
-            outSize += abs(packetsize)
-            outCount += 1
-            if len(cum) == 0:
-                cum.append(packetsize)
-                total.append(abs(packetsize))
-                pos.append(0)
-                neg.append(abs(packetsize))
-            else:
-                cum.append(cum[-1] + packetsize)
-                total.append(total[-1] + abs(packetsize))
-                pos.append(pos[-1] + 0)
-                neg.append(neg[-1] + abs(packetsize))
-
-    # add feature
-    features.append(inCount)
-    features.append(outCount)
-    features.append(outSize)
-    features.append(inSize)
+    # cumulated packetsizes
+    cum = np.cumsum(sizes)
+    total = np.cumsum(np.abs(sizes))
 
     cumFeatures = np.interp(np.linspace(total[0], total[-1], num_interpolation_points + 1), total, cum)
-    for el in islice(cumFeatures, 1, None):
-        features.append(el)
+    features.extend(cumFeatures[1:].tolist())
+
+    return features
+
+
+def extract_many(instances, num_interpolation_points=100):
+    """CUMUL features of several traces.
+
+    Returns a `(len(instances), 4 + num_interpolation_points)` matrix whose
+    rows are equal to `extract` applied to each trace.
+    """
+    return extract_sizes_many([_packet_sizes(instance) for instance in instances],
+                              num_interpolation_points)
+
+
+def extract_sizes_many(packet_sizes_list, num_interpolation_points=100):
+    """Batched version of `extract_sizes`."""
+    num_traces = len(packet_sizes_list)
+    features = np.zeros((num_traces, 4 + num_interpolation_points))
+    if num_traces == 0:
+        return features
+
+    # concatenate all the traces and reduce every trace segment at once
+    sizes = [np.asarray(s) for s in packet_sizes_list]
+    sizes = [s[s != 0] for s in sizes]
+    lengths = np.array([len(s) for s in sizes])
+    if not lengths.all():
+        raise ValueError("Cannot extract CUMUL features from an empty trace.")
+    starts = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+    all_sizes = np.concatenate(sizes)
+
+    incoming = np.where(all_sizes > 0, all_sizes, 0)
+    outgoing = np.where(all_sizes < 0, -all_sizes, 0)
+    features[:, 0] = np.add.reduceat(all_sizes > 0, starts)
+    features[:, 1] = np.add.reduceat(all_sizes < 0, starts)
+    features[:, 2] = np.add.reduceat(outgoing, starts)
+    features[:, 3] = np.add.reduceat(incoming, starts)
+
+    # the interpolation points differ per trace, so interpolate each segment
+    for i, s in enumerate(sizes):
+        cum = np.cumsum(s)
+        total = np.cumsum(np.abs(s))
+        points = np.linspace(total[0], total[-1], num_interpolation_points + 1)
+        features[i, 4:] = np.interp(points, total, cum)[1:]
 
     return features
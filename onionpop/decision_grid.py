@@ -0,0 +1,217 @@
+"""
+    `decision_grid.py`
+
+    Precomputed decision surface of a 2-D RBF support vector machine.
+
+    The decision function of an RBF SVM is
+
+        f(x) = sum_i a_i exp(-gamma ||x - s_i||^2) + b
+
+    and for a two dimensional input it can be tabulated on a regular grid
+    and bilinearly interpolated. On a grid cell of size hx * hy, the
+    interpolation error is at most
+
+        hx^2 / 8 max|f_xx| + hy^2 / 8 max|f_yy|
+
+    where the maxima are taken over the cell. We bound the second derivatives
+    of every kernel term over every cell, which gives a guaranteed error bound
+    per cell. Samples whose interpolated value is within that bound of zero,
+    or that fall outside the grid, are scored with the exact SVM, so the
+    predicted labels are always the exact ones.
+"""
+import numpy as np
+
+
+def _interval_min_sq(centers, lo, hi):
+    """min of (t - c)^2 for t in [lo, hi], for every center c and interval.
+
+    Output has shape (len(centers), len(lo)).
+    """
+    below = lo[None, :] - centers[:, None]
+    above = centers[:, None] - hi[None, :]
+    dist = np.maximum(np.maximum(below, above), 0)
+    return dist ** 2
+
+
+def _interval_max_curvature(centers, lo, hi, gamma):
+    """max of |4 gamma^2 d^2 - 2 gamma| exp(-gamma d^2) for t in [lo, hi],
+    where d = t - c, for every center c and interval.
+
+    The function of d is even and its extrema are at d = 0 and
+    d^2 = 3 / (2 gamma), so we check those and the interval ends.
+    """
+    def phi(d_sq):
+        return np.abs(4 * gamma ** 2 * d_sq - 2 * gamma) * np.exp(-gamma * d_sq)
+
+    d_lo = lo[None, :] - centers[:, None]
+    d_hi = hi[None, :] - centers[:, None]
+    bound = np.maximum(phi(d_lo ** 2), phi(d_hi ** 2))
+    # d = 0 inside the interval
+    bound = np.where((d_lo <= 0) & (d_hi >= 0), np.maximum(bound, 2 * gamma), bound)
+    # |d| = sqrt(3 / (2 gamma)) inside the interval
+    d_star = np.sqrt(1.5 / gamma)
+    contains_star = ((d_lo <= d_star) & (d_hi >= d_star)) | ((d_lo <= -d_star) & (d_hi >= -d_star))
+    bound = np.where(contains_star, np.maximum(bound, phi(d_star ** 2)), bound)
+    return bound
+
+
+class RBFDecisionFunction(object):
+    """Exact decision function of an RBF SVM, computed with NumPy.
+
+    Used by models loaded without the training library.
+    """
+
+    def __init__(self, support_vectors, dual_coef, intercept, gamma):
+        self.support_vectors = np.asarray(support_vectors, dtype=np.float64)
+        self.dual_coef = np.ravel(dual_coef).astype(np.float64)
+        self.intercept = float(np.ravel(intercept)[0])
+        self.gamma = float(gamma)
+
+    def __call__(self, X):
+        X = np.asarray(X, dtype=np.float64)
+        sq_dist = ((X[:, None, :] - self.support_vectors[None, :, :]) ** 2).sum(axis=2)
+        return np.exp(-self.gamma * sq_dist).dot(self.dual_coef) + self.intercept
+
+    def get_state(self):
+        return ({'intercept': self.intercept, 'gamma': self.gamma},
+                {'support_vectors': self.support_vectors, 'dual_coef': self.dual_coef})
+
+    @classmethod
+    def from_state(cls, params, arrays):
+        return cls(arrays['support_vectors'], arrays['dual_coef'], params['intercept'], params['gamma'])
+
+    @classmethod
+    def from_svm(cls, svm):
+        """Extract the decision function of a trained scikit-learn RBF SVM."""
+        if svm.kernel != 'rbf':
+            raise ValueError("Only the RBF kernel is supported.")
+        return cls(svm.support_vectors_, svm.dual_coef_, svm.intercept_, getattr(svm, '_gamma', svm.gamma))
+
+
+class DecisionGrid(object):
+    """Bilinear interpolation table of a 2-D RBF decision function.
+
+    Parameters
+    ----------
+    support_vectors : array, shape (n_SV, 2)
+    dual_coef : array, shape (n_SV,)
+    gamma : float
+        RBF kernel coefficient.
+    decision_function : callable
+        Exact decision function, used to fill the table.
+    lower, upper : array, shape (2,)
+        Corners of the area covered by the grid.
+    max_error : float
+        Target bound on the interpolation error. The resolution is doubled
+        until every cell meets it or `max_resolution` is reached; cells
+        that still do not meet it always use the exact decision function.
+    """
+
+    def __init__(self, support_vectors, dual_coef, gamma, decision_function, lower, upper,
+                 max_error=1e-3, resolution=64, max_resolution=1024):
+        self.support_vectors = np.asarray(support_vectors, dtype=np.float64)
+        self.dual_coef = np.ravel(dual_coef).astype(np.float64)
+        self.gamma = float(gamma)
+        self.lower = np.asarray(lower, dtype=np.float64)
+        self.upper = np.asarray(upper, dtype=np.float64)
+        self.max_error = max_error
+
+        while True:
+            self.resolution = resolution
+            self.error_bound = self._error_bound(resolution)
+            if self.error_bound.max() <= max_error or resolution >= max_resolution:
+                break
+            resolution *= 2
+
+        # cells that do not meet the target are always computed exactly
+        self.error_bound[self.error_bound > max_error] = np.inf
+
+        # values at the grid nodes
+        xs, ys = self._axes(resolution)
+        nodes = np.column_stack([np.repeat(xs, len(ys)), np.tile(ys, len(xs))])
+        self.values = np.ravel(decision_function(nodes)).reshape(len(xs), len(ys))
+
+    def get_state(self):
+        """Return `(params, arrays)` to store the grid without pickling.
+
+        The support vectors are only needed to build the grid and are not
+        stored.
+        """
+        params = {'gamma': self.gamma, 'max_error': self.max_error, 'resolution': self.resolution}
+        arrays = {'lower': self.lower, 'upper': self.upper,
+                  'values': self.values, 'error_bound': self.error_bound}
+        return params, arrays
+
+    @classmethod
+    def from_state(cls, params, arrays):
+        grid = cls.__new__(cls)
+        grid.support_vectors = None
+        grid.dual_coef = None
+        grid.gamma = params['gamma']
+        grid.max_error = params['max_error']
+        grid.resolution = params['resolution']
+        grid.lower = arrays['lower']
+        grid.upper = arrays['upper']
+        grid.values = arrays['values']
+        grid.error_bound = arrays['error_bound']
+        return grid
+
+    def _axes(self, resolution):
+        return (np.linspace(self.lower[0], self.upper[0], resolution + 1),
+                np.linspace(self.lower[1], self.upper[1], resolution + 1))
+
+    def _error_bound(self, resolution):
+        """Interpolation error bound of every cell, shape (resolution, resolution)."""
+        xs, ys = self._axes(resolution)
+        hx = xs[1] - xs[0]
+        hy = ys[1] - ys[0]
+        sv_x = self.support_vectors[:, 0]
+        sv_y = self.support_vectors[:, 1]
+        abs_coef = np.abs(self.dual_coef)[:, None]
+
+        # the kernel factorizes as exp(-gamma dx^2) exp(-gamma dy^2)
+        curv_x = abs_coef * _interval_max_curvature(sv_x, xs[:-1], xs[1:], self.gamma)
+        curv_y = _interval_max_curvature(sv_y, ys[:-1], ys[1:], self.gamma)
+        decay_x = abs_coef * np.exp(-self.gamma * _interval_min_sq(sv_x, xs[:-1], xs[1:]))
+        decay_y = np.exp(-self.gamma * _interval_min_sq(sv_y, ys[:-1], ys[1:]))
+
+        bound = hx ** 2 / 8 * curv_x.T.dot(decay_y) + hy ** 2 / 8 * decay_x.T.dot(curv_y)
+        # allow for the rounding errors of the tabulated values
+        return bound + 1e-9 * (np.abs(self.dual_coef).sum() + 1)
+
+    def interpolate(self, X):
+        """Return the interpolated decision values and their error bounds.
+
+        Samples outside the grid get an infinite error bound.
+        """
+        X = np.asarray(X, dtype=np.float64)
+        scaled = (X - self.lower) / (self.upper - self.lower) * self.resolution
+        inside = np.all((scaled >= 0) & (scaled <= self.resolution), axis=1)
+        scaled = np.clip(scaled, 0, self.resolution)
+
+        cell = np.minimum(np.floor(scaled).astype(np.intp), self.resolution - 1)
+        frac = scaled - cell
+        i, j = cell[:, 0], cell[:, 1]
+        u, v = frac[:, 0], frac[:, 1]
+        values = ((1 - u) * (1 - v) * self.values[i, j] + u * (1 - v) * self.values[i + 1, j] +
+                  (1 - u) * v * self.values[i, j + 1] + u * v * self.values[i + 1, j + 1])
+
+        error_bound = np.where(inside, self.error_bound[i, j], np.inf)
+        return values, error_bound
+
+    @classmethod
+    def from_svm(cls, svm, X, margin=0.1, **kwargs):
+        """Build the grid of a trained scikit-learn RBF `OneClassSVM`.
+
+        The grid covers the bounding box of the (scaled) training samples `X`,
+        extended by `margin` times its size on each side.
+        """
+        if svm.kernel != 'rbf':
+            raise ValueError("Decision grids are only supported for the RBF kernel.")
+        X = np.asarray(X, dtype=np.float64)
+        lower = X.min(axis=0)
+        upper = X.max(axis=0)
+        extent = np.maximum(upper - lower, 1e-6)
+        return cls(svm.support_vectors_, svm.dual_coef_, getattr(svm, '_gamma', svm.gamma),
+                   svm.decision_function, lower - margin * extent, upper + margin * extent,
+                   **kwargs)
@@ -0,0 +1,125 @@
+"""
+    `feature_cache.py`
+
+    Content-addressed on-disk cache of feature arrays.
+
+    An entry is a set of named arrays stored as `.npy` files under a key
+    derived from the content it was computed from (e.g. the bytes of a
+    dataset or of a trace) and the version of the code that computed it:
+
+        cache_dir/
+            <namespace>/<key[:2]>/<key>/<name>.npy
+
+    Changing the input or bumping the version changes the key, so stale
+    entries are never read; they can be removed by deleting the directory.
+    Entries are written to a temporary directory and renamed into place, so
+    concurrent writers (e.g. the worker processes of `extract_dataset`) never
+    expose partial entries. Arrays are read memory-mapped by default.
+
+        cache = FeatureCache('~/.cache/onionpop')
+        key = cache.key(file_digest('website.libsvm'), 'load_data', 1)
+        arrays = cache.get('datasets', key)
+        if arrays is None:
+            arrays = compute()
+            cache.put('datasets', key, arrays)
+"""
+import os
+import shutil
+import hashlib
+import tempfile
+import numpy as np
+
+from os.path import join, isdir, expanduser
+
+
+def file_digest(fpath, block_size=1 << 20):
+    """SHA-1 hex digest of the content of a file."""
+    digest = hashlib.sha1()
+    with open(fpath, 'rb') as fi:
+        while True:
+            block = fi.read(block_size)
+            if not block:
+                break
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class FeatureCache(object):
+    """Arrays cached on disk by content key.
+
+    Parameters
+    ----------
+    root : str
+        Directory of the cache. It is created if needed.
+    mmap_mode : str
+        Memory-map mode of the arrays read (see `np.load`), None to read
+        them in memory.
+    """
+
+    def __init__(self, root, mmap_mode='r'):
+        self.root = expanduser(root)
+        self.mmap_mode = mmap_mode
+        self.hits = 0
+        self.misses = 0
+        if not isdir(self.root):
+            try:
+                os.makedirs(self.root)
+            except OSError:
+                # created by a concurrent process
+                if not isdir(self.root):
+                    raise
+
+    @staticmethod
+    def key(*parts):
+        """Key of an entry: the hash of its parts (strings, bytes or numbers)."""
+        digest = hashlib.sha1()
+        for part in parts:
+            if not isinstance(part, bytes):
+                part = repr(part).encode('utf-8')
+            # length prefix, so that ('ab', 'c') and ('a', 'bc') differ
+            digest.update(str(len(part)).encode('ascii') + b':' + part)
+        return digest.hexdigest()
+
+    def _entry_dir(self, namespace, key):
+        return join(self.root, namespace, key[:2], key)
+
+    def get(self, namespace, key):
+        """Return the arrays of an entry (name -> array), or None if missing."""
+        entry_dir = self._entry_dir(namespace, key)
+        if not isdir(entry_dir):
+            self.misses += 1
+            return None
+        arrays = {}
+        for fname in os.listdir(entry_dir):
+            if fname.endswith('.npy'):
+                arrays[fname[:-len('.npy')]] = np.load(join(entry_dir, fname), mmap_mode=self.mmap_mode,
+                                                       allow_pickle=False)
+        self.hits += 1
+        return arrays
+
+    def put(self, namespace, key, arrays):
+        """Store the arrays (name -> array) of an entry."""
+        entry_dir = self._entry_dir(namespace, key)
+        parent = os.path.dirname(entry_dir)
+        if not isdir(parent):
+            try:
+                os.makedirs(parent)
+            except OSError:
+                if not isdir(parent):
+                    raise
+
+        tmp_dir = tempfile.mkdtemp(prefix='.tmp-', dir=parent)
+        try:
+            for name, array in arrays.items():
+                np.save(join(tmp_dir, name + '.npy'), np.asarray(array), allow_pickle=False)
+            os.rename(tmp_dir, entry_dir)
+        except OSError:
+            # the entry has been stored by a concurrent writer
+            if not isdir(entry_dir):
+                raise
+        finally:
+            if isdir(tmp_dir):
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses}
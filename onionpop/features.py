@@ -1,8 +1,59 @@
-from onionpop.cumul import extract
+import sys
+import array
+import numpy as np
+
+from onionpop.cumul import extract_sizes
+from onionpop.kfp import extract_arrays as extract_kfp_arrays
 
 CELL_TYPE_KEYS = ['CREATE', 'CREATED', 'CREATE2', 'CREATED2', 'CREATED_FAST', 'CREATE_FAST', 'DESTROY', 'RELAY', 'RELAY_EARLY', 'UNKNOWN']
 CELL_COMMAND_KEYS = ['BEGIN', 'BEGIN_DIR', 'CONNECTED', 'DATA', 'END', 'DROP', 'SENDME', 'EXTEND', 'EXTENDED', 'EXTEND2', 'EXTENDED2', 'TRUNCATE', 'TRUNCATED', 'RESOLVE', 'RESOLVED', 'ESTABLISH_INTRO', 'ESTABLISH_RENDEZVOUS', 'INTRODUCE1', 'INTRODUCE2', 'RENDEZVOUS1', 'RENDEZVOUS2', 'INTRO_ESTABLISHED', 'RENDEZVOUS_ESTABLISHED', 'INTRODUCE_ACK', 'SIG_CIRCPURPCHANGED', 'SIG_NEWCIRC', 'SIG_NEWSTRM', 'UNKNOWN']
 
+# integer codes used for the columnar cell storage
+CELL_TYPE_CODES = dict((k, i) for i, k in enumerate(CELL_TYPE_KEYS))
+CELL_COMMAND_CODES = dict((k, i) for i, k in enumerate(CELL_COMMAND_KEYS))
+# "TYPE_COMMAND" combination keys, coded as type_code * len(CELL_COMMAND_KEYS) + command_code
+COMBO_KEYS = ["{}_{}".format(t, m) for t in CELL_TYPE_KEYS for m in CELL_COMMAND_KEYS]
+COMBO_CODES = dict((k, i) for i, k in enumerate(COMBO_KEYS))
+
+# layout of a block of `Features.count_cells_multi`: the absolute counts
+# (the first four indexed by is_sent | is_outbound << 1) then the combinations
+ABSOLUTE_COUNT_KEYS = ['recv_out', 'sent_in', 'recv_in', 'sent_out', 'total_sent', 'total_recv', 'total_in', 'total_out']
+COUNT_KEYS = ABSOLUTE_COUNT_KEYS + COMBO_KEYS
+COUNT_INDEX = dict((k, i) for i, k in enumerate(COUNT_KEYS))
+
+def count_columns(limits=()):
+    """Column names of `Features.count_cells_multi(limits)`, with the same
+    "<key>_first_<limit>" names as `Features.count_cells`.
+    """
+    columns = []
+    for limit in limits:
+        columns.extend("{}_first_{}".format(k, limit) for k in COUNT_KEYS)
+    columns.extend(COUNT_KEYS)
+    return columns
+
+UNKNOWN_TYPE = CELL_TYPE_CODES['UNKNOWN']
+UNKNOWN_COMMAND = CELL_COMMAND_CODES['UNKNOWN']
+DESTROY_TYPE = CELL_TYPE_CODES['DESTROY']
+
+def _parse_table(keys):
+    """Name -> code table for parsing, with the upper and lower case names."""
+    table = {}
+    for i, k in enumerate(keys):
+        table[k] = i
+        table[k.lower()] = i
+    return table
+
+_CELL_TYPE_TABLE = _parse_table(CELL_TYPE_KEYS)
+_CELL_COMMAND_TABLE = _parse_table(CELL_COMMAND_KEYS)
+
+def parse_code(name, table, default):
+    """Code of a cell type or command name, in any case."""
+    code = table.get(name)
+    if code is None:
+        # mixed case names are rare
+        code = table.get(name.upper(), default)
+    return code
+
 class Node(object):
     def __init__(self, nickname, ip_address, fingerprint, is_relay, is_exit, is_guard):
         self.nickname = nickname
@@ -13,77 +64,266 @@ class Node(object):
         self.is_guard = is_guard
 
 class Cell(object):
+    """A cell, with its type and command stored as integer codes (indices
+    into `CELL_TYPE_KEYS` and `CELL_COMMAND_KEYS`). Unknown names are coded
+    as 'UNKNOWN'.
+    """
+    __slots__ = ('chan_id', 'circ_id', 'timestamp', 'ctype_code', 'command_code', 'is_sent', 'is_outbound')
+
     def __init__(self, chan_id, circ_id, timestamp, cell_type, cell_command, is_sent, is_outbound):
         self.chan_id = chan_id
         self.circ_id = circ_id
         self.timestamp = timestamp # e.g., 1235.465052
-        cell_type_upper = cell_type.upper()
-        self.ctype = cell_type_upper if cell_type_upper in CELL_TYPE_KEYS else 'UNKNOWN'
-        cell_command_upper = cell_command.upper()
-        self.command = cell_command_upper if cell_command_upper in CELL_COMMAND_KEYS else "UNKNOWN"
+        self.ctype_code = parse_code(cell_type, _CELL_TYPE_TABLE, UNKNOWN_TYPE)
+        self.command_code = parse_code(cell_command, _CELL_COMMAND_TABLE, UNKNOWN_COMMAND)
         self.is_sent = is_sent
         self.is_outbound = is_outbound
 
+    @classmethod
+    def from_codes(cls, chan_id, circ_id, timestamp, ctype_code, command_code, is_sent, is_outbound):
+        """Build a cell from already-parsed codes."""
+        cell = cls.__new__(cls)
+        cell.chan_id = chan_id
+        cell.circ_id = circ_id
+        cell.timestamp = timestamp
+        cell.ctype_code = ctype_code
+        cell.command_code = command_code
+        cell.is_sent = is_sent
+        cell.is_outbound = is_outbound
+        return cell
+
+    @property
+    def ctype(self):
+        return CELL_TYPE_KEYS[self.ctype_code]
+
+    @property
+    def command(self):
+        return CELL_COMMAND_KEYS[self.command_code]
+
+class CellCounter(object):
+    """Running counts over the cells of a circuit, updated in O(1) per cell.
+
+    Keeps everything the purpose and position features need (the absolute
+    counts per direction and the per "TYPE_COMMAND" counts) together with the
+    first and last timestamps, so those features can be read at any moment
+    without rescanning the cells.
+    """
+    # index into `direction_counts`: is_sent | is_outbound << 1
+    RECV_OUT, SENT_IN, RECV_IN, SENT_OUT = range(4)
+
+    def __init__(self):
+        self.num_cells = 0
+        self.direction_counts = [0, 0, 0, 0]
+        self.combo_counts = array.array('I', [0]) * len(COMBO_KEYS) # combo code -> count
+        self.first_timestamp = None
+        self.last_timestamp = None
+
+    def add(self, timestamp, ctype_code, command_code, is_sent, is_outbound):
+        self.num_cells += 1
+        self.direction_counts[(1 if is_sent else 0) | (2 if is_outbound else 0)] += 1
+        combo = ctype_code * len(CELL_COMMAND_KEYS) + command_code
+        self.combo_counts[combo] += 1
+        if self.first_timestamp is None:
+            self.first_timestamp = timestamp
+        self.last_timestamp = timestamp
+
+    def count_array(self):
+        """All the counts, in the `COUNT_KEYS` layout."""
+        recv_out, sent_in, recv_in, sent_out = self.direction_counts
+        counts = np.empty(len(COUNT_KEYS), dtype=np.int64)
+        counts[:8] = (recv_out, sent_in, recv_in, sent_out, sent_in + sent_out, recv_in + recv_out,
+                      sent_in + recv_in, sent_out + recv_out)
+        counts[8:] = np.frombuffer(self.combo_counts, dtype=np.uintc)
+        return counts
+
+    def lifetime(self):
+        if self.num_cells > 1:
+            return self.last_timestamp - self.first_timestamp
+        else:
+            return 0
+
+
 class Circuit(object):
-    def __init__(self, chan_id, circ_id, prev_node, next_node, cell_list=None):
-        self.cells = cell_list if cell_list is not None else [] # chronologically-ordered list of cells
+    """A circuit whose cells are stored column-wise in growable typed arrays.
+
+    Instead of keeping one `Cell` object per cell, we keep the timestamps in
+    a float64 array, the cell type and command as int8 codes (indices into
+    `CELL_TYPE_KEYS` and `CELL_COMMAND_KEYS`) and the `is_sent` and
+    `is_outbound` flags bit-packed, eight cells per byte.
+    """
+    INITIAL_CAPACITY = 16
+
+    def __init__(self, chan_id, circ_id, prev_node, next_node, cell_list=None, store_cells=True):
         self.chan_id = chan_id
         self.circ_id = circ_id
         self.prev_node = prev_node
         self.next_node = next_node
+        self.store_cells = store_cells
+        self.counter = CellCounter()
+
+        # chronologically-ordered cell columns, only the first `num_cells`
+        # entries of each array are valid
+        self.num_cells = 0
+        self._timestamps = np.empty(self.INITIAL_CAPACITY, dtype=np.float64)
+        self._ctypes = np.empty(self.INITIAL_CAPACITY, dtype=np.int8)
+        self._commands = np.empty(self.INITIAL_CAPACITY, dtype=np.int8)
+        self._sent_bits = np.zeros(self.INITIAL_CAPACITY // 8, dtype=np.uint8)
+        self._outbound_bits = np.zeros(self.INITIAL_CAPACITY // 8, dtype=np.uint8)
+
+        if cell_list is not None:
+            for cell in cell_list:
+                self._append_cell(cell)
 
     def add_cell(self, cell):
         if cell is not None and cell.chan_id == self.chan_id and cell.circ_id == self.circ_id:
-            self.cells.append(cell)
+            self._append_cell(cell)
+
+    def _append_cell(self, cell):
+        self.append(cell.timestamp, cell.ctype_code, cell.command_code, cell.is_sent, cell.is_outbound)
+
+    def append(self, timestamp, ctype_code, command_code, is_sent, is_outbound):
+        """Append a cell given its column values, without building a `Cell`."""
+        self.counter.add(timestamp, ctype_code, command_code, is_sent, is_outbound)
+        if not self.store_cells:
+            return
+
+        i = self.num_cells
+        if i == len(self._timestamps):
+            self._grow()
+
+        self._timestamps[i] = timestamp
+        self._ctypes[i] = ctype_code
+        self._commands[i] = command_code
+        # np.packbits/unpackbits use big-endian bit order within a byte
+        bit = 0x80 >> (i & 7)
+        if is_sent:
+            self._sent_bits[i >> 3] |= bit
+        if is_outbound:
+            self._outbound_bits[i >> 3] |= bit
+        self.num_cells = i + 1
+
+    def release_cells(self):
+        """Free the stored cells and stop storing new ones.
+
+        The running counts of `counter` are kept up to date, so the purpose
+        and position features can still be extracted.
+        """
+        self.store_cells = False
+        self.num_cells = 0
+        self._timestamps = self._timestamps[:0].copy()
+        self._ctypes = self._ctypes[:0].copy()
+        self._commands = self._commands[:0].copy()
+        self._sent_bits = self._sent_bits[:0].copy()
+        self._outbound_bits = self._outbound_bits[:0].copy()
+
+    def _grow(self):
+        capacity = max(2 * len(self._timestamps), self.INITIAL_CAPACITY)
+        self._timestamps = _resized(self._timestamps, capacity)
+        self._ctypes = _resized(self._ctypes, capacity)
+        self._commands = _resized(self._commands, capacity)
+        self._sent_bits = _resized(self._sent_bits, capacity // 8)
+        self._outbound_bits = _resized(self._outbound_bits, capacity // 8)
+
+    @property
+    def nbytes(self):
+        """Bytes allocated for the cell columns."""
+        return (self._timestamps.nbytes + self._ctypes.nbytes + self._commands.nbytes +
+                self._sent_bits.nbytes + self._outbound_bits.nbytes)
+
+    def memory_size(self):
+        """Approximate bytes held by the circuit: the cell columns with their
+        array headers, the counter and the objects themselves. Short
+        circuits are dominated by the fixed part, e.g. the counts of every
+        cell type and command.
+        """
+        counter = self.counter
+        objects = [self, self.__dict__, counter, counter.__dict__, counter.direction_counts,
+                   counter.combo_counts, self._timestamps, self._ctypes, self._commands,
+                   self._sent_bits, self._outbound_bits]
+        for node in (self.prev_node, self.next_node):
+            if node is not None:
+                objects.extend((node, node.__dict__))
+        return sum(sys.getsizeof(o) for o in objects)
+
+    @property
+    def timestamps(self):
+        return self._timestamps[:self.num_cells]
+
+    @property
+    def ctypes(self):
+        return self._ctypes[:self.num_cells]
+
+    @property
+    def commands(self):
+        return self._commands[:self.num_cells]
+
+    @property
+    def is_sent(self):
+        return np.unpackbits(self._sent_bits)[:self.num_cells].astype(bool)
+
+    @property
+    def is_outbound(self):
+        return np.unpackbits(self._outbound_bits)[:self.num_cells].astype(bool)
+
+    @property
+    def cells(self):
+        """List of `Cell` objects, rebuilt from the columns for compatibility."""
+        return [Cell.from_codes(self.chan_id, self.circ_id, timestamp, ctype, command, is_sent, is_outbound)
+                for timestamp, ctype, command, is_sent, is_outbound
+                in zip(self.timestamps.tolist(), self.ctypes.tolist(), self.commands.tolist(),
+                       self.is_sent.tolist(), self.is_outbound.tolist())]
+
+
+def _resized(array, capacity):
+    new_array = np.zeros(capacity, dtype=array.dtype)
+    new_array[:len(array)] = array
+    return new_array
+
+
+# count columns of the purpose and position features
+CIRCUIT_COUNT_COLUMNS = np.array([COUNT_INDEX[k] for k in [
+    'CREATE_UNKNOWN', 'CREATED_UNKNOWN', 'CREATE2_UNKNOWN', 'CREATED2_UNKNOWN',
+    'RELAY_EARLY_EXTEND', 'RELAY_EXTENDED', 'RELAY_EARLY_EXTEND2', 'RELAY_EXTENDED2',
+    'RELAY_UNKNOWN', 'RELAY_EARLY_UNKNOWN',
+    'total_sent', 'total_recv', 'sent_out', 'sent_in', 'recv_out', 'recv_in']])
+
 
 class Features(object):
     def __init__(self, circuit):
         self.circuit = circuit
         self.circuit_features = None
+        self._circuit_features_num_cells = None
 
     def count_cells(self, key_list, types_filter=[], commands_filter=[], limit=None):
+        c = self.circuit
+        n = c.num_cells if limit is None else min(limit, c.num_cells)
+
+        is_sent = c.is_sent[:n]
+        is_outbound = c.is_outbound[:n]
+        is_recv = ~is_sent
+        is_inbound = ~is_outbound
+
         # absolute count keys
-        d = {'recv_in':0, 'sent_in':0, 'recv_out':0, 'sent_out':0,
-             'total_in':0, 'total_out':0, 'total_recv':0, 'total_sent':0}
+        d = {}
+        d['sent_out'] = int(np.count_nonzero(is_sent & is_outbound)) # sent to the outbound side
+        d['sent_in'] = int(np.count_nonzero(is_sent & is_inbound)) # sent to the inbound side
+        d['recv_in'] = int(np.count_nonzero(is_recv & is_outbound)) # received from the inbound side
+        d['recv_out'] = int(np.count_nonzero(is_recv & is_inbound)) # received from the outbound side
+        d['total_sent'] = d['sent_out'] + d['sent_in']
+        d['total_recv'] = d['recv_in'] + d['recv_out']
+        d['total_in'] = d['sent_in'] + d['recv_in']
+        d['total_out'] = d['sent_out'] + d['recv_out']
+
         # cell-specific counts
+        type_codes = [CELL_TYPE_CODES[t] for t in types_filter if t in CELL_TYPE_CODES]
+        command_codes = [CELL_COMMAND_CODES[m] for m in commands_filter if m in CELL_COMMAND_CODES]
+        ctypes = c.ctypes[:n]
+        commands = c.commands[:n]
+        selected = np.isin(ctypes, type_codes) & np.isin(commands, command_codes)
+        combos = ctypes[selected].astype(np.intp) * len(CELL_COMMAND_KEYS) + commands[selected]
+        combo_counts = np.bincount(combos, minlength=len(COMBO_KEYS))
         for k in key_list:
-            d[k] = 0
-
-        iter_count = 0
-        for cell in self.circuit.cells:
-            iter_count += 1
-            if limit is not None and iter_count > limit:
-                break
-
-            # first handle absolute counts
-            if cell.is_sent:
-                if cell.is_outbound:
-                    # sent to the outbound side
-                    d['sent_out'] += 1
-                    d['total_sent'] += 1
-                    d['total_out'] += 1
-                else:
-                    # sent to the inbound side
-                    d['sent_in'] += 1
-                    d['total_sent'] += 1
-                    d['total_in'] += 1
-            else:
-                if cell.is_outbound:
-                    # received from the inbound side
-                    d['recv_in'] += 1
-                    d['total_recv'] += 1
-                    d['total_in'] += 1
-                else:
-                    # received from the outbound side
-                    d['recv_out'] += 1
-                    d['total_recv'] += 1
-                    d['total_out'] += 1
-
-            # now handle cell-specific counts
-            if cell.ctype in types_filter and cell.command in commands_filter:
-                k = "{}_{}".format(cell.ctype, cell.command)
-                if k in d:
-                    d[k] += 1
+            d[k] = int(combo_counts[COMBO_CODES[k]]) if k in COMBO_CODES else 0
 
         if limit is None:
             return d
@@ -93,43 +333,83 @@ class Features(object):
                 d2["{}_first_{}".format(k, limit)] = d[k]
             return d2
 
-    def get_cell_sequence(self, max_cells=None):
-        sequence = []
-        for cell in self.circuit.cells:
-            # webpage classifier was trained on only
-            # client-side received and client-side sent cells
-            if cell.is_outbound: # this cell was on the server side
-                continue
-
-            # the remaining cells were either received or sent on client side
-            direction_code = 0
-            if cell.is_sent:
-                # sent toward the client
-                direction_code = -1
-            else:
-                # received from the client, would be headed toward the server
-                direction_code = 1
-
-            sequence.append((cell.timestamp, direction_code))
-
-            if max_cells is not None and len(sequence) >= max_cells:
-                break
+    def count_cells_multi(self, limits=()):
+        """Count the cells of several prefixes and of the whole circuit in a
+        single pass.
+
+        Parameters
+        ----------
+        limits : list of int
+            Prefix lengths. A limit longer than the circuit counts all of it.
+
+        Output
+        ------
+            counts : np.array of int64
+                One block of `len(COUNT_KEYS)` counts per limit, in the order
+                of `limits`, followed by the block of the whole circuit (see
+                `count_columns` for the column names). The counts are not
+                filtered by cell type or command.
+        """
+        c = self.circuit
+        block = len(COUNT_KEYS)
+        num_direction = 4
+        n = c.num_cells
+        bounds = sorted(set(min(limit, n) for limit in limits))
+
+        # count every cell once, in the segment between consecutive limits,
+        # then accumulate the segments into prefixes
+        segments = np.searchsorted(bounds, np.arange(n), side='right')
+        directions = c.is_sent.astype(np.intp) | (c.is_outbound.astype(np.intp) << 1)
+        combos = c.ctypes.astype(np.intp) * len(CELL_COMMAND_KEYS) + c.commands
+        width = num_direction + len(COMBO_KEYS)
+        idx = np.concatenate([segments * width + directions, segments * width + num_direction + combos])
+        seg_counts = np.bincount(idx, minlength=(len(bounds) + 1) * width).reshape(-1, width)
+        prefix_counts = np.cumsum(seg_counts, axis=0)[:len(bounds)]
+
+        counts = np.empty((len(limits) + 1, block), dtype=np.int64)
+        for i, limit in enumerate(limits):
+            row = prefix_counts[bounds.index(min(limit, n))]
+            recv_out, sent_in, recv_in, sent_out = row[:num_direction]
+            counts[i, :8] = (recv_out, sent_in, recv_in, sent_out, sent_in + sent_out, recv_in + recv_out,
+                             sent_in + recv_in, sent_out + recv_out)
+            counts[i, 8:] = row[num_direction:]
+        # the running counts also cover the cells that are not stored
+        counts[-1] = c.counter.count_array()
+        return counts.ravel()
+
+    def get_cell_arrays(self, max_cells=None):
+        """Return the client-side cells as `(timestamps, directions)` arrays.
+
+        See `get_cell_sequence` for the direction codes.
+        """
+        c = self.circuit
+        # webpage classifier was trained on only
+        # client-side received and client-side sent cells
+        client_side = ~c.is_outbound
+        timestamps = c.timestamps[client_side]
+        # sent toward the client (-1) or received from the client,
+        # would be headed toward the server (1)
+        directions = np.where(c.is_sent[client_side], -1, 1)
+        if max_cells is not None:
+            timestamps = timestamps[:max_cells]
+            directions = directions[:max_cells]
+        return timestamps, directions
 
-        return sequence
+    def get_cell_sequence(self, max_cells=None):
+        timestamps, directions = self.get_cell_arrays(max_cells=max_cells)
+        return list(zip(timestamps.tolist(), directions.tolist()))
 
     def get_lifetime(self):
-        if len(self.circuit.cells) > 1:
-            return self.circuit.cells[-1].timestamp - self.circuit.cells[0].timestamp
-        else:
-            return 0
+        return self.circuit.counter.lifetime()
 
     def _extract_circuit_features(self):
         if not self.circuit:
             return None
 
         # if we have already computed the features, don't bother recomputing
-        # we set self.circuit_features to None if recomputation is required
-        if self.circuit_features is not None:
+        # we recompute when cells have been added since the last call
+        counter = self.circuit.counter
+        if self.circuit_features is not None and self._circuit_features_num_cells == counter.num_cells:
             return self.circuit_features
 
         c = self.circuit
@@ -143,25 +423,11 @@ class Features(object):
         features.append(1 if c.prev_node and c.prev_node.is_guard else 0)
         features.append(1 if c.prev_node and c.prev_node.is_exit else 0)
 
-        cell_type_keys = ["CREATE", "CREATED", "CREATE2", "CREATED2", "RELAY", "RELAY_EARLY"]
-        cell_command_keys = ["EXTEND", "EXTENDED", "EXTEND2", "EXTENDED2", "UNKNOWN"]
-        combo_keys = ['CREATE_UNKNOWN', 'CREATED_UNKNOWN', 'CREATE2_UNKNOWN', 'CREATED2_UNKNOWN',
-        'RELAY_EARLY_EXTEND', 'RELAY_EXTENDED', 'RELAY_EARLY_EXTEND2', 'RELAY_EXTENDED2',
-        'RELAY_UNKNOWN', 'RELAY_EARLY_UNKNOWN']
-
-        counts = self.count_cells(combo_keys,
-            types_filter=cell_type_keys, commands_filter=cell_command_keys)
-
-        for label in combo_keys:
-            features.append(counts[label])
-
-        features.append(counts['total_sent'])
-        features.append(counts['total_recv'])
-        features.append(counts['sent_out'])
-        features.append(counts['sent_in'])
-        features.append(counts['recv_out'])
-        features.append(counts['recv_in'])
+        # every type and command in these keys passes the cell type and
+        # command filters, so the unfiltered running counts can be used
+        features.extend(counter.count_array()[CIRCUIT_COUNT_COLUMNS].tolist())
 
+        self._circuit_features_num_cells = counter.num_cells
         self.circuit_features = features
         return self.circuit_features
 
@@ -175,15 +441,20 @@ class Features(object):
         if not self.circuit:
             return None
 
-        cells = self.get_cell_sequence()
-        features = extract(cells)
+        _, directions = self.get_cell_arrays()
+        features = extract_sizes(directions)
 
         return features
 
+    def extract_kfp_features(self, max_size=175):
+        """k-FP features of the client-side cells (see `onionpop.kfp`),
+        computed from the cell arrays. None if there are no such cells.
+        """
+        if not self.circuit:
+            return None
+
+        timestamps, directions = self.get_cell_arrays()
+        if len(timestamps) == 0:
+            return None
 
-test_node1 = Node('R1', '1.1.1.1', '0000', True, False, True)
-test_node2 = Node('R2', '1.1.1.2', 'FFFF', False, False, True)
-test_circuit = Circuit(0, 0, test_node1, test_node2)
-test_circuit.add_cell(Cell(0, 0, 1, 'create', 'UNKNOWN', True, True))
-test_circuit.add_cell(Cell(0, 0, 0, 'created', 'UNKNOWN', True, True))
-test_circuit.add_cell(Cell(0, 0, 1, 'relay', 'UNKNOWN', True, True))
+        return extract_kfp_arrays(timestamps - timestamps[0], directions, max_size=max_size)
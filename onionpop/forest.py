@@ -0,0 +1,146 @@
+"""
+    `forest.py`
+
+    Random forests flattened into NumPy node arrays, so that trained forests
+    can be evaluated without the library that trained them.
+
+    All trees are stored in the same node tables and nodes refer to their
+    children by absolute index. Internal nodes send a sample to the left
+    child if `x[feature] <= threshold` and to the right child otherwise.
+    A node is a leaf if its feature is `LEAF`; leaves are their own left and
+    right children, so that traversal can run a fixed number of steps
+    without checking for leaves.
+"""
+import numpy as np
+
+LEAF = -1
+
+
+class FlatForest(object):
+    """A trained random forest classifier as flat node arrays.
+
+    Parameters
+    ----------
+    feature : array of int, shape (n_nodes,)
+        Feature tested at each node, `LEAF` for leaves.
+    threshold : array of float, shape (n_nodes,)
+        Split threshold of each internal node.
+    left, right : array of int, shape (n_nodes,)
+        Absolute index of the children of each node.
+    value : array of float, shape (n_nodes, n_classes)
+        Class probabilities at each leaf.
+    roots : array of int, shape (n_trees,)
+        Index of the root node of each tree.
+    classes : array, shape (n_classes,)
+        Class labels, in the column order of `value`.
+    input_dtype : numpy dtype
+        Samples are cast to this type before being compared with the
+        thresholds, to reproduce the training library's comparisons.
+    """
+
+    def __init__(self, feature, threshold, left, right, value, roots, classes, input_dtype=np.float64):
+        self.feature = np.asarray(feature, dtype=np.int32)
+        self.threshold = np.asarray(threshold, dtype=np.float64)
+        self.left = np.asarray(left, dtype=np.int32)
+        self.right = np.asarray(right, dtype=np.int32)
+        self.value = np.asarray(value, dtype=np.float64)
+        self.roots = np.asarray(roots, dtype=np.int32)
+        self.classes = np.asarray(classes)
+        self.input_dtype = np.dtype(input_dtype)
+        self.max_depth = self._max_depth()
+
+    @property
+    def n_trees(self):
+        return len(self.roots)
+
+    @property
+    def n_nodes(self):
+        return len(self.feature)
+
+    def _max_depth(self):
+        depth = 0
+        nodes = self.roots
+        while True:
+            nodes = nodes[self.feature[nodes] != LEAF]
+            if len(nodes) == 0:
+                return depth
+            nodes = np.concatenate((self.left[nodes], self.right[nodes]))
+            depth += 1
+
+    def apply(self, X):
+        """Return the leaf reached by each sample in each tree.
+
+        Output
+        ------
+            leaves : array of int, shape (n_samples, n_trees)
+        """
+        X = np.asarray(X).astype(self.input_dtype).astype(np.float64)
+        if X.ndim == 1:
+            X = X.reshape(1, -1)
+        rows = np.repeat(np.arange(len(X)), self.n_trees)
+        nodes = np.tile(self.roots, len(X))
+        for _ in range(self.max_depth):
+            # leaves test feature LEAF (the last column), but both of their
+            # children are themselves
+            go_left = X[rows, self.feature[nodes]] <= self.threshold[nodes]
+            nodes = np.where(go_left, self.left[nodes], self.right[nodes])
+        return nodes.reshape(len(X), self.n_trees)
+
+    def predict_proba(self, X):
+        leaves = self.apply(X)
+        # summed tree after tree (not pairwise, the trees are not the last
+        # axis), in the order scikit-learn accumulates them
+        return self.value[leaves].sum(axis=1) / self.n_trees
+
+    def predict(self, X):
+        return self.classes[np.argmax(self.predict_proba(X), axis=1)]
+
+    def get_state(self):
+        """Return `(params, arrays)` to store the forest without pickling."""
+        arrays = {'feature': self.feature, 'threshold': self.threshold,
+                  'left': self.left, 'right': self.right, 'value': self.value,
+                  'roots': self.roots, 'classes': self.classes}
+        return {'input_dtype': self.input_dtype.name}, arrays
+
+    @classmethod
+    def from_state(cls, params, arrays):
+        return cls(input_dtype=params['input_dtype'], **arrays)
+
+    @classmethod
+    def from_estimator(cls, estimator):
+        """Flatten a trained forest.
+
+        Supports forests exposing scikit-learn style trees, i.e. an
+        `estimators_` list whose elements have a `tree_` attribute.
+        """
+        if not hasattr(estimator, 'estimators_'):
+            raise ValueError("Cannot flatten a {}: it does not expose its trees.".format(
+                type(estimator).__name__))
+
+        features, thresholds, lefts, rights, values, roots = [], [], [], [], [], []
+        offset = 0
+        for tree_estimator in estimator.estimators_:
+            tree = tree_estimator.tree_
+            is_leaf = tree.children_left == -1
+            node_idx = np.arange(tree.node_count) + offset
+            features.append(np.where(is_leaf, LEAF, tree.feature))
+            thresholds.append(tree.threshold)
+            lefts.append(np.where(is_leaf, node_idx, tree.children_left + offset))
+            rights.append(np.where(is_leaf, node_idx, tree.children_right + offset))
+            # single-output trees: value has shape (n_nodes, 1, n_classes)
+            value = tree.value[:, 0, :].astype(np.float64)
+            normalizer = value.sum(axis=1, keepdims=True)
+            # scikit-learn >= 1.4 stores the class fractions, which are used
+            # as is; older versions store counts, normalized at prediction
+            if not np.allclose(normalizer[normalizer != 0], 1):
+                normalizer[normalizer == 0] = 1
+                value = value / normalizer
+            values.append(value)
+            roots.append(offset)
+            offset += tree.node_count
+
+        # scikit-learn trees compare float32 samples against the thresholds
+        return cls(np.concatenate(features), np.concatenate(thresholds),
+                   np.concatenate(lefts), np.concatenate(rights),
+                   np.concatenate(values), roots, estimator.classes_,
+                   input_dtype=np.float32)
@@ -0,0 +1,141 @@
+"""
+    `instrumentation.py`
+
+    Optional per-stage counters and latency histograms for `MiddleEarthModel`.
+
+        stats = PipelineStats()
+        model.set_instrumentation(stats)
+        ...
+        print(model.stats())
+
+    The model calls `record_stage` every time a stage (one classifier of the
+    cascade) is evaluated and `record_prediction` once per prediction. Any
+    object with those two methods can be plugged instead of `PipelineStats`,
+    e.g. to forward the measures to PrivCount. When no instrumentation is
+    set, the model only pays for an `is None` check per prediction.
+"""
+import bisect
+import threading
+
+# upper bounds of the latency buckets: 1us, 2us, 4us, ..., ~8.4s
+LATENCY_BUCKETS = [1e-6 * 2 ** i for i in range(24)]
+
+
+class LatencyHistogram(object):
+    """Latency histogram with power-of-two buckets."""
+
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)  # last bucket: overflow
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds, count=1):
+        """Record `count` observations of `seconds`."""
+        self.counts[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += count
+        self.count += count
+        self.total += seconds * count
+        self.max = max(self.max, seconds)
+
+    def percentile(self, q):
+        """Upper bound of the bucket holding the `q`-th percentile."""
+        if self.count == 0:
+            return 0.0
+        rank = q / 100.0 * self.count
+        seen = 0
+        for i, c in enumerate(self.counts):
+            seen += c
+            if seen >= rank and c:
+                return LATENCY_BUCKETS[i] if i < len(LATENCY_BUCKETS) else self.max
+        return self.max
+
+    def snapshot(self):
+        return {
+            'count': self.count,
+            'total_seconds': self.total,
+            'mean_seconds': self.total / self.count if self.count else 0.0,
+            'max_seconds': self.max,
+            'p50_seconds': self.percentile(50),
+            'p99_seconds': self.percentile(99),
+            'buckets': [[bound, c] for bound, c in zip(LATENCY_BUCKETS + [None], self.counts) if c],
+        }
+
+
+class StageStats(object):
+    """Counters and latencies of one stage of the cascade."""
+
+    def __init__(self, name):
+        self.name = name
+        self.evaluated = 0
+        self.rejected = 0
+        self.extract_latency = LatencyHistogram()
+        self.inference_latency = LatencyHistogram()
+
+    def snapshot(self):
+        return {
+            'name': self.name,
+            'evaluated': self.evaluated,
+            'rejected': self.rejected,
+            'extract_latency': self.extract_latency.snapshot(),
+            'inference_latency': self.inference_latency.snapshot(),
+        }
+
+
+class PipelineStats(object):
+    """Collects the measures of a `MiddleEarthModel`.
+
+    Parameters
+    ----------
+    hook : callable
+        Optional callback, called after each measure as
+        `hook(stage_name, num_circuits, extract_seconds, inference_seconds, num_rejected)`
+        for stages and `hook(None, num_circuits, 0, seconds, num_rejected)`
+        for whole predictions.
+    """
+
+    def __init__(self, hook=None):
+        self.hook = hook
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.predictions = 0
+            self.detected = 0
+            self.latency = LatencyHistogram()
+            self.stages = {}
+            self._stage_order = []
+
+    def record_stage(self, stage, num_circuits, extract_seconds, inference_seconds, num_rejected):
+        """Record the evaluation of `stage` on `num_circuits` circuits
+        (timings are for all of them), of which `num_rejected` stopped there.
+        """
+        with self._lock:
+            stats = self.stages.get(stage)
+            if stats is None:
+                stats = self.stages[stage] = StageStats(stage)
+                self._stage_order.append(stage)
+            stats.evaluated += num_circuits
+            stats.rejected += num_rejected
+            stats.extract_latency.add(extract_seconds / num_circuits, num_circuits)
+            stats.inference_latency.add(inference_seconds / num_circuits, num_circuits)
+        if self.hook is not None:
+            self.hook(stage, num_circuits, extract_seconds, inference_seconds, num_rejected)
+
+    def record_prediction(self, num_circuits, seconds, num_rejected):
+        """Record a prediction of `num_circuits` circuits that took `seconds`."""
+        with self._lock:
+            self.predictions += num_circuits
+            self.detected += num_circuits - num_rejected
+            self.latency.add(seconds / num_circuits, num_circuits)
+        if self.hook is not None:
+            self.hook(None, num_circuits, 0.0, seconds, num_rejected)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'predictions': self.predictions,
+                'detected': self.detected,
+                'latency': self.latency.snapshot(),
+                'stages': [self.stages[s].snapshot() for s in self._stage_order],
+            }
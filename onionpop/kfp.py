@@ -1,375 +1,236 @@
+"""
+    `kfp.py`
+
+    k-FP features (Hayes and Danezis, "k-fingerprinting: a Robust Scalable
+    Website Fingerprinting Technique").
+
+    The trace is parsed once into a time and a direction array and every
+    statistic is computed from those arrays. A trace can be given either as
+    tab-separated "<timestamp>\t<direction>" lines or as a `Circuit` (or its
+    `Features`), in which case the client-side cells are used directly.
+"""
 import math
 import numpy as np
 
 
-def neighborhood(iterable):
-    iterator = iter(iterable)
-    prev = (0)
-    item = iterator.next()  # throws StopIteration if empty.
-    for next in iterator:
-        yield (prev, item, next)
-        prev = item
-        item = next
-    yield (prev, item, None)
+def parse_trace(trace):
+    """Return the `(times, directions)` arrays of a trace.
 
+    Times are relative to the first entry of the trace. Directions are 1 for
+    outgoing and -1 for incoming packets.
+    """
+    from onionpop.features import Circuit, Features
+    if isinstance(trace, Circuit):
+        trace = Features(trace)
+    if isinstance(trace, Features):
+        timestamps, directions = trace.get_cell_arrays()
+        if len(timestamps) == 0:
+            return np.zeros(0), np.zeros(0, dtype=np.int8)
+        return timestamps - timestamps[0], directions.astype(np.int8)
+    return parse_lines(trace)
 
-def chunkIt(seq, num):
-    avg = len(seq) / float(num)
-    out = []
-    last = 0.0
-    while last < len(seq):
-        out.append(seq[int(last):int(last + avg)])
-        last += avg
-    return out
 
+def parse_lines(trace_data):
+    """Parse tab-separated "<timestamp>\t<direction>" lines.
 
-def get_pkt_list(trace_data):
+    Lines with a 'None' direction are skipped, and a direction that is not
+    positive counts as incoming.
+    """
     if not trace_data:
-        return []
-    first_line = trace_data[0]
-    first_line = first_line.split('\t')
+        return np.zeros(0), np.zeros(0, dtype=np.int8)
 
-    first_time = float(first_line[0])
-    dta = []
+    first_time = float(trace_data[0].split('\t')[0])
+    times = []
+    directions = []
     for line in trace_data:
-        a = line
-        b = a.strip().split('\t')
-        if b[1] == 'None':
+        fields = line.strip().split('\t')
+        if fields[1] == 'None':
             continue
+        times.append(float(fields[0]))
+        directions.append(1 if float(fields[1]) > 0 else -1)
 
-        if float(b[1]) > 0:
-            # dta.append(((float(b[0])- first_time), abs(int(b[2])), 1))
-            dta.append(((float(b[0]) - first_time), 1))
-        else:
-            # dta.append(((float(b[1]) - first_time), abs(int(b[2])), -1))
-            dta.append(((float(b[0]) - first_time), -1))
-    return dta
+    return np.array(times) - first_time, np.array(directions, dtype=np.int8)
+
+
+def chunk_sums(values, num):
+    """Sums of `values` split in `num` chunks, as done by k-FP's `chunkIt`.
+
+    The chunk boundaries follow the same floating point steps as the
+    original implementation, so the number of chunks is `num` or `num + 1`.
+    """
+    avg = len(values) / float(num)
+    bounds = []
+    last = 0.0
+    while last < len(values):
+        bounds.append((int(last), int(last + avg)))
+        last += avg
+    if not bounds:
+        return np.zeros(0, dtype=np.int64)
+    bounds = np.minimum(np.array(bounds), len(values))
+    cumsum = np.concatenate(([0], np.cumsum(values)))
+    return cumsum[bounds[:, 1]] - cumsum[bounds[:, 0]]
 
 
-def In_Out(list_data):
-    In = []
-    Out = []
-    for p in list_data:
-        if p[1] == -1:
-            In.append(p)
-        if p[1] == 1:
-            Out.append(p)
-    return In, Out
+def _summary(values):
+    """std, mean, median, min and max of `values` (zeros if empty)."""
+    if len(values) == 0:
+        return 0, 0, 0, 0, 0
+    return np.std(values), np.mean(values), np.percentile(values, 50), np.min(values), np.max(values)
 
 
 # TIME FEATURES #####################
 
-def inter_pkt_time(list_data):
-    if len(list_data) < 2:
-        return [0.0]
-    times = [x[0] for x in list_data]
-    temp = []
-    for elem, next_elem in zip(times, times[1:] + [times[0]]):
-        temp.append(next_elem-elem)
-    return temp[:-1]
-
-
-def interarrival_times(list_data):
-    In, Out = In_Out(list_data)
-    IN = inter_pkt_time(In)
-    OUT = inter_pkt_time(Out)
-    TOTAL = inter_pkt_time(list_data)
-    return IN, OUT, TOTAL
-
-
-def interarrival_maxminmeansd_stats(list_data):
-    interstats = []
-    In, Out, Total = interarrival_times(list_data)
-    if In and Out:
-        avg_in = sum(In)/float(len(In))
-        avg_out = sum(Out)/float(len(Out))
-        avg_total = sum(Total)/float(len(Total))
-        interstats.append((max(In), max(Out), max(Total), avg_in, avg_out, avg_total, np.std(In), np.std(Out), np.std(Total), np.percentile(In, 75), np.percentile(Out, 75), np.percentile(Total, 75)))
-    elif Out and not In:
-        avg_out = sum(Out)/float(len(Out))
-        avg_total = sum(Total)/float(len(Total))
-        interstats.append((0, max(Out), max(Total), 0, avg_out, avg_total, 0, np.std(Out), np.std(Total), 0, np.percentile(Out, 75), np.percentile(Total, 75)))
-    elif In and not Out:
-        avg_in = sum(In)/float(len(In))
-        avg_total = sum(Total)/float(len(Total))
-        interstats.append((max(In), 0, max(Total), avg_in, 0, avg_total, np.std(In), 0, np.std(Total), np.percentile(In, 75), 0, np.percentile(Total, 75)))
-    else:
-        interstats.extend(([0]*15))
-    return interstats
-
-
-def time_percentile_stats(trace_data):
-    Total = get_pkt_list(trace_data)
-    In, Out = In_Out(Total)
-    In1 = [x[0] for x in In]
-    Out1 = [x[0] for x in Out]
-    Total1 = [x[0] for x in Total]
-    STATS = []
-    if In1:
-        STATS.append(np.percentile(In1, 25))  # return 25th percentile
-        STATS.append(np.percentile(In1, 50))
-        STATS.append(np.percentile(In1, 75))
-        STATS.append(np.percentile(In1, 100))
-    if not In1:
-        STATS.extend(([0]*4))
-    if Out1:
-        STATS.append(np.percentile(Out1, 25))  # return 25th percentile
-        STATS.append(np.percentile(Out1, 50))
-        STATS.append(np.percentile(Out1, 75))
-        STATS.append(np.percentile(Out1, 100))
-    if not Out1:
-        STATS.extend(([0]*4))
-    if Total1:
-        STATS.append(np.percentile(Total1, 25))  # return 25th percentile
-        STATS.append(np.percentile(Total1, 50))
-        STATS.append(np.percentile(Total1, 75))
-        STATS.append(np.percentile(Total1, 100))
-    if not Total1:
-        STATS.extend(([0]*4))
-    return STATS
-
-
-def number_pkt_stats(trace_data):
-    Total = get_pkt_list(trace_data)
-    In, Out = In_Out(Total)
-    return len(In), len(Out), len(Total)
-
-
-def first_and_last_30_pkts_stats(trace_data):
-    Total = get_pkt_list(trace_data)
-    first30 = Total[:30]
-    last30 = Total[-30:]
-    first30in = []
-    first30out = []
-    for p in first30:
-        if p[1] == -1:
-            first30in.append(p)
-        if p[1] == 1:
-            first30out.append(p)
-    last30in = []
-    last30out = []
-    for p in last30:
-        if p[1] == -1:
-            last30in.append(p)
-        if p[1] == 1:
-            last30out.append(p)
+def interarrival_stats(times, is_in, is_out):
+    """Max, mean, std and 75th percentile of the interarrival times of the
+    incoming, outgoing and all packets.
+    """
     stats = []
-    stats.append(len(first30in))
-    stats.append(len(first30out))
-    stats.append(len(last30in))
-    stats.append(len(last30out))
+    deltas = []
+    for selected_times in (times[is_in], times[is_out], times):
+        d = np.diff(selected_times)
+        deltas.append(d if len(d) else np.zeros(1))
+    stats.extend(np.max(d) for d in deltas)
+    stats.extend(np.mean(d) for d in deltas)
+    stats.extend(np.std(d) for d in deltas)
+    stats.extend(np.percentile(d, 75) for d in deltas)
     return stats
 
 
-# concentration of outgoing packets in chunks of 20 packets
-def pkt_concentration_stats(trace_data):
-    Total = get_pkt_list(trace_data)
-    chunks = [Total[x:x + 20] for x in xrange(0, len(Total), 20)]
-    concentrations = []
-    for item in chunks:
-        c = 0
-        for p in item:
-            if p[1] == 1:
-                c += 1
-        concentrations.append(c)
-    if not concentrations:
-        raise ValueError
-    return np.std(concentrations), sum(concentrations)/float(len(concentrations)), np.percentile(concentrations, 50), min(concentrations), max(concentrations), concentrations
-
-
-# Average number packets sent and received per second
-def number_per_sec(trace_data):
-    Total = get_pkt_list(trace_data)
-    last_time = Total[-1][0]
-    last_second = math.ceil(last_time)
-    temp = []
-    l = []
-    for i in range(1, int(last_second)+1):
-        c = 0
-        for p in Total:
-            if p[0] <= i:
-                c += 1
-        temp.append(c)
-    for prev, item, next in neighborhood(temp):
-        x = item - prev
-        l.append(x)
-    avg_number_per_sec = sum(l)/float(len(l))
-    return avg_number_per_sec, np.std(l), np.percentile(l, 50), min(l), max(l), l
+def time_percentile_stats(times, is_in, is_out):
+    """25th, 50th, 75th and 100th percentiles of the packet times."""
+    stats = []
+    for selected_times in (times[is_in], times[is_out], times):
+        if len(selected_times):
+            stats.extend(np.percentile(selected_times, [25, 50, 75, 100]))
+        else:
+            stats.extend([0] * 4)
+    return stats
+
+
+def first_and_last_30_pkts_stats(is_in, is_out):
+    return [np.count_nonzero(is_in[:30]), np.count_nonzero(is_out[:30]),
+            np.count_nonzero(is_in[-30:]), np.count_nonzero(is_out[-30:])]
+
+
+def pkt_concentrations(is_out):
+    """Number of outgoing packets in each chunk of 20 packets."""
+    return np.add.reduceat(is_out.astype(np.int64), np.arange(0, len(is_out), 20))
+
+
+def number_per_sec(times):
+    """Number of packets in each second of the trace.
+
+    The trace spans as many seconds as the ceiling of its last time, and a
+    packet at time t is counted in the second ceil(t) (or the first second
+    if t <= 0).
+    """
+    if len(times) == 0:
+        return np.zeros(0, dtype=np.int64)
+    last_second = int(math.ceil(times[-1]))
+    if last_second < 1:
+        return np.zeros(0, dtype=np.int64)
+    seconds = np.clip(np.ceil(times), 1, last_second + 1).astype(np.int64)
+    return np.bincount(seconds, minlength=last_second + 2)[1:last_second + 1]
 
 
 # Variant of packet ordering features from http://cacr.uwaterloo.ca/techreports/2014/cacr2014-05.pdf
-def avg_pkt_ordering_stats(trace_data):
-    Total = get_pkt_list(trace_data)
-    c1 = 0
-    c2 = 0
-    temp1 = []
-    temp2 = []
-    for p in Total:
-        if p[1] == 1:
-            temp1.append(c1)
-        c1 += 1
-        if p[1] == -1:
-            temp2.append(c2)
-        c2 += 1
-    avg_in = sum(temp1)/float(len(temp1))
-    avg_out = sum(temp2)/float(len(temp2))
-
-    return avg_in, avg_out, np.std(temp1), np.std(temp2)
-
-
-def perc_inc_out(trace_data):
-    Total = get_pkt_list(trace_data)
-    In, Out = In_Out(Total)
-    percentage_in = len(In)/float(len(Total))
-    percentage_out = len(Out)/float(len(Total))
-    return percentage_in, percentage_out
-
-# SIZE FEATURES #####################
-
-# def total_size(list_data):
-#    return sum([x[1] for x in list_data])
-
-# def in_out_size(list_data):
-#    In, Out = In_Out(list_data)
-#    size_in = sum([x[1] for x in In])
-#    size_out = sum([x[1] for x in Out])
-#    return size_in, size_out
-
-# def average_total_pkt_size(list_data):
-#    return np.mean([x[1] for x in list_data])
-
-# def average_in_out_pkt_size(list_data):
-#    In, Out = In_Out(list_data)
-#    average_size_in = np.mean([x[1] for x in In])
-#    average_size_out = np.mean([x[1] for x in Out])
-#    return average_size_in, average_size_out
-
-# def variance_total_pkt_size(list_data):
-#    return np.var([x[1] for x in list_data])
-
-# def variance_in_out_pkt_size(list_data):
-#    In, Out = In_Out(list_data)
-#    var_size_in = np.var([x[1] for x in In])
-#    var_size_out = np.var([x[1] for x in Out])
-#    return var_size_in, var_size_out
-
-# def std_total_pkt_size(list_data):
-#    return np.std([x[1] for x in list_data])
-
-# def std_in_out_pkt_size(list_data):
-#    In, Out = In_Out(list_data)
-#    std_size_in = np.std([x[1] for x in In])
-#    std_size_out = np.std([x[1] for x in Out])
-#    return std_size_in, std_size_out
-
-# def max_in_out_pkt_size(list_data):
-#    In, Out = In_Out(list_data)
-#    max_size_in = max([x[1] for x in In])
-#    max_size_out = max([x[1] for x in Out])
-#    return max_size_in, max_size_out
-
-# def unique_pkt_lengths(list_data):
-#    pass
+def avg_pkt_ordering_stats(is_in, is_out):
+    """Mean and std of the positions of the outgoing and incoming packets.
 
-# FEATURE FUNCTION #####################
+    Returned as (mean outgoing, mean incoming, std outgoing, std incoming),
+    the order in which the original k-FP code returns them.
+    """
+    order_out = np.flatnonzero(is_out)
+    order_in = np.flatnonzero(is_in)
+    avg_out = np.mean(order_out) if len(order_out) else 0
+    avg_in = np.mean(order_in) if len(order_in) else 0
+    std_out = np.std(order_out) if len(order_out) else 0
+    std_in = np.std(order_in) if len(order_in) else 0
+    return avg_out, avg_in, std_out, std_in
 
 
-# If size information available add them in to function below
+# FEATURE FUNCTION #####################
+
 def extract(trace_data, max_size=175):
-    list_data = get_pkt_list(trace_data)
-    ALL_FEATURES = []
+    """k-FP feature vector of a trace, or None if the trace is empty.
 
-    # ------TIME--------
-    intertimestats = [x for x in interarrival_maxminmeansd_stats(list_data)[0]]
-    timestats = time_percentile_stats(trace_data)
-    number_pkts = list(number_pkt_stats(trace_data))
+    `trace_data` is a list of tab-separated lines, a `Circuit` or a
+    `Features` object.
+    """
+    times, directions = parse_trace(trace_data)
+    return extract_arrays(times, directions, max_size=max_size)
+
+
+def extract_arrays(times, directions, max_size=175):
+    """k-FP feature vector of a trace given as parsed arrays."""
+    times = np.asarray(times, dtype=np.float64)
+    directions = np.asarray(directions)
+    is_in = directions == -1
+    is_out = directions == 1
+
+    number_pkts = [int(np.count_nonzero(is_in)), int(np.count_nonzero(is_out)), len(directions)]
     if not any(number_pkts):
         # empty trace
         return None
 
-    thirtypkts = first_and_last_30_pkts_stats(trace_data)
-    try:
-        stdconc, avgconc, medconc, minconc, maxconc, conc = pkt_concentration_stats(trace_data)
-    except ValueError:
-        stdconc, avgconc, medconc, minconc, maxconc, conc = (0, 0, 0, 0, 0, 0)
-    avg_per_sec, std_per_sec, med_per_sec, min_per_sec, max_per_sec, per_sec = number_per_sec(trace_data)
-    avg_order_in, avg_order_out, std_order_in, std_order_out = avg_pkt_ordering_stats(trace_data)
-    perc_in, perc_out = perc_inc_out(trace_data)
-
-    altconc = []
-    alt_per_sec = []
-    altconc = [sum(x) for x in chunkIt(conc, 70)]
-    alt_per_sec = [sum(x) for x in chunkIt(per_sec, 20)]
+    # ------TIME--------
+    intertimestats = interarrival_stats(times, is_in, is_out)
+    timestats = time_percentile_stats(times, is_in, is_out)
+    thirtypkts = first_and_last_30_pkts_stats(is_in, is_out)
+
+    conc = pkt_concentrations(is_out)
+    stdconc, avgconc, medconc, minconc, maxconc = _summary(conc)
+
+    per_sec = number_per_sec(times)
+    std_per_sec, avg_per_sec, med_per_sec, min_per_sec, max_per_sec = _summary(per_sec)
+
+    avg_order_in, avg_order_out, std_order_in, std_order_out = avg_pkt_ordering_stats(is_in, is_out)
+    perc_in = number_pkts[0] / float(number_pkts[2])
+    perc_out = number_pkts[1] / float(number_pkts[2])
+
+    altconc = chunk_sums(conc, 70).tolist()
+    alt_per_sec = chunk_sums(per_sec, 20).tolist() if len(per_sec) else [0] * 20
     if len(altconc) == 70:
         altconc.append(0)
     if len(alt_per_sec) == 20:
         alt_per_sec.append(0)
 
-    # ------SIZE--------
-
-    # tot_size = total_size(list_data)
-    # in_size, out_size = in_out_size(list_data)
-    # avg_total_size = average_total_pkt_size(list_data)
-    # avg_size_in, avg_size_out = average_in_out_pkt_size(list_data)
-    # var_total_size = variance_total_pkt_size(list_data)
-    # var_size_in, var_size_out = variance_in_out_pkt_size(list_data)
-    # std_total_size = std_total_pkt_size(list_data)
-    # std_size_in, std_size_out = std_in_out_pkt_size(list_data)
-    # max_size_in, max_size_out = max_in_out_pkt_size(list_data)
-
     # TIME Features
-    ALL_FEATURES.extend(intertimestats)
-    ALL_FEATURES.extend(timestats)
-    ALL_FEATURES.extend(number_pkts)
-    ALL_FEATURES.extend(thirtypkts)
-    ALL_FEATURES.append(stdconc)
-    ALL_FEATURES.append(avgconc)
-    ALL_FEATURES.append(avg_per_sec)
-    ALL_FEATURES.append(std_per_sec)
-    ALL_FEATURES.append(avg_order_in)
-    ALL_FEATURES.append(avg_order_out)
-    ALL_FEATURES.append(std_order_in)
-    ALL_FEATURES.append(std_order_out)
-    ALL_FEATURES.append(medconc)
-    ALL_FEATURES.append(med_per_sec)
-    ALL_FEATURES.append(min_per_sec)
-    ALL_FEATURES.append(max_per_sec)
-    ALL_FEATURES.append(maxconc)
-    ALL_FEATURES.append(perc_in)
-    ALL_FEATURES.append(perc_out)
-    ALL_FEATURES.extend(altconc)
-    ALL_FEATURES.extend(alt_per_sec)
-    ALL_FEATURES.append(sum(altconc))
-    ALL_FEATURES.append(sum(alt_per_sec))
-    ALL_FEATURES.append(sum(intertimestats))
-    ALL_FEATURES.append(sum(timestats))
-    ALL_FEATURES.append(sum(number_pkts))
-
-    # SIZE FEATURES
-    # ALL_FEATURES.append(tot_size)
-    # ALL_FEATURES.append(in_size)
-    # ALL_FEATURES.append(out_size)
-    # ALL_FEATURES.append(avg_total_size)
-    # ALL_FEATURES.append(avg_size_in)
-    # ALL_FEATURES.append(avg_size_out)
-    # ALL_FEATURES.append(var_total_size)
-    # ALL_FEATURES.append(var_size_in)
-    # ALL_FEATURES.append(var_size_out)
-    # ALL_FEATURES.append(std_total_size)
-    # ALL_FEATURES.append(std_size_in)
-    # ALL_FEATURES.append(std_size_out)
-    # ALL_FEATURES.append(max_size_in)
-    # ALL_FEATURES.append(max_size_out)
+    all_features = []
+    all_features.extend(intertimestats)
+    all_features.extend(timestats)
+    all_features.extend(number_pkts)
+    all_features.extend(thirtypkts)
+    all_features.append(stdconc)
+    all_features.append(avgconc)
+    all_features.append(avg_per_sec)
+    all_features.append(std_per_sec)
+    all_features.append(avg_order_in)
+    all_features.append(avg_order_out)
+    all_features.append(std_order_in)
+    all_features.append(std_order_out)
+    all_features.append(medconc)
+    all_features.append(med_per_sec)
+    all_features.append(min_per_sec)
+    all_features.append(max_per_sec)
+    all_features.append(maxconc)
+    all_features.append(perc_in)
+    all_features.append(perc_out)
+    all_features.extend(altconc)
+    all_features.extend(alt_per_sec)
+    all_features.append(sum(altconc))
+    all_features.append(sum(alt_per_sec))
+    all_features.append(sum(intertimestats))
+    all_features.append(sum(timestats))
+    all_features.append(sum(number_pkts))
 
     # This is optional, since all other features are of equal size this gives the first n features
     # of this particular feature subset, some may be padded with 0's if too short.
+    all_features.extend(conc[:max_size].tolist())
+    all_features.extend(per_sec[:max_size].tolist())
 
-    ALL_FEATURES.extend(conc)
-
-    ALL_FEATURES.extend(per_sec)
-
-    while len(ALL_FEATURES) < max_size:
-        ALL_FEATURES.append(0)
-    features = ALL_FEATURES[:max_size]
+    features = np.zeros(max_size)
+    num_features = min(len(all_features), max_size)
+    features[:num_features] = all_features[:num_features]
 
-    return tuple(features)
+    return tuple(features.tolist())
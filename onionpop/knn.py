@@ -0,0 +1,166 @@
+"""
+    `knn.py`
+
+    k-FP fingerprint matching (Hayes and Danezis, "k-fingerprinting: a
+    Robust Scalable Website Fingerprinting Technique").
+
+    The fingerprint of a trace is the vector of the leaves it reaches in
+    each tree of a random forest trained on k-FP features, and traces are
+    compared with the Hamming distance between fingerprints: the number of
+    trees in which they end in different leaves. A trace is assigned to a
+    site when its `k` nearest reference fingerprints all belong to it.
+
+        index = FingerprintIndex(forest)
+        index.add(X_train, y_train)
+        labels = index.predict(X_test, k=3)
+
+    Each leaf is numbered within its tree, so fingerprints are stored in the
+    smallest unsigned integer type that holds the leaf numbers (one byte per
+    tree for trees of up to 256 leaves), in a growable array. Distances are
+    computed for a whole batch of queries at once, tree by tree.
+"""
+import numpy as np
+
+from onionpop.forest import FlatForest, LEAF
+
+
+class FingerprintIndex(object):
+    """Reference fingerprints for k-nearest-neighbour matching.
+
+    Parameters
+    ----------
+    forest : onionpop.forest.FlatForest
+        Forest trained on k-FP features. Its trees must be stored one after
+        the other, as done by `FlatForest.from_estimator`.
+    unknown : label
+        Label predicted when the nearest neighbours disagree.
+    """
+    INITIAL_CAPACITY = 64
+    # max number of (query, reference) pairs compared at once
+    BLOCK_SIZE = 1 << 22
+
+    def __init__(self, forest, unknown=-1):
+        self.forest = forest
+        self.unknown = unknown
+
+        # number of every leaf within its tree
+        is_leaf = forest.feature == LEAF
+        leaf_rank = np.cumsum(is_leaf) - 1
+        tree_of_node = np.searchsorted(forest.roots, np.arange(forest.n_nodes), side='right') - 1
+        first_rank = np.concatenate(([0], np.cumsum(is_leaf)))[forest.roots]
+        self._leaf_number = leaf_rank - first_rank[tree_of_node]
+        max_leaves = int(self._leaf_number[is_leaf].max()) + 1 if is_leaf.any() else 1
+        self.dtype = np.min_scalar_type(max_leaves - 1)
+
+        self.size = 0
+        self._fingerprints = np.empty((self.INITIAL_CAPACITY, forest.n_trees), dtype=self.dtype)
+        self._labels = np.empty(self.INITIAL_CAPACITY, dtype=np.asarray(forest.classes).dtype)
+
+    @classmethod
+    def from_classifier(cls, clf, **kwargs):
+        """Index on the forest of a trained `classifiers.KFPClassifier`."""
+        forest = clf.forest if clf.forest is not None else FlatForest.from_estimator(clf._clf)
+        return cls(forest, **kwargs)
+
+    @property
+    def fingerprints(self):
+        return self._fingerprints[:self.size]
+
+    @property
+    def labels(self):
+        return self._labels[:self.size]
+
+    def fingerprint(self, X):
+        """Fingerprints of the rows of `X`, shape (n_samples, n_trees)."""
+        return self._leaf_number[self.forest.apply(X)].astype(self.dtype)
+
+    def add(self, X, labels):
+        """Add reference traces (or new sites) to the index."""
+        labels = np.ravel(labels)
+        fingerprints = self.fingerprint(X)
+        if len(fingerprints) != len(labels):
+            raise ValueError("Got {} traces and {} labels.".format(len(fingerprints), len(labels)))
+
+        size = self.size + len(labels)
+        # new sites may have labels of another type, e.g. strings
+        dtype = np.result_type(self._labels, labels)
+        if size > len(self._fingerprints):
+            capacity = max(2 * len(self._fingerprints), size)
+            self._fingerprints = _resized(self._fingerprints, capacity)
+            self._labels = _resized(self._labels, capacity, dtype=dtype)
+        elif dtype != self._labels.dtype:
+            self._labels = self._labels.astype(dtype)
+        self._fingerprints[self.size:size] = fingerprints
+        self._labels[self.size:size] = labels
+        self.size = size
+
+    def distances(self, fingerprints):
+        """Hamming distances between fingerprints and all the references,
+        shape (n_queries, size).
+        """
+        references = self.fingerprints
+        dist = np.zeros((len(fingerprints), self.size), dtype=np.min_scalar_type(self.forest.n_trees))
+        for t in range(self.forest.n_trees):
+            dist += fingerprints[:, t, None] != references[None, :, t]
+        return dist
+
+    def query(self, X, k=3):
+        """Return the indices and distances of the `k` nearest references of
+        each row of `X`, closest first, both of shape (n_samples, k).
+        """
+        if self.size == 0:
+            raise ValueError("The index is empty.")
+        k = min(k, self.size)
+        fingerprints = self.fingerprint(X)
+
+        indices = np.empty((len(fingerprints), k), dtype=np.intp)
+        distances = np.empty((len(fingerprints), k), dtype=np.intp)
+        block = max(1, self.BLOCK_SIZE // self.size)
+        for start in range(0, len(fingerprints), block):
+            dist = self.distances(fingerprints[start:start + block])
+            nearest = np.argpartition(dist, k - 1, axis=1)[:, :k]
+            nearest_dist = np.take_along_axis(dist, nearest, axis=1)
+            # closest first, then by insertion order (which of several
+            # references tied at the k-th distance are returned is arbitrary)
+            order = np.lexsort((nearest, nearest_dist), axis=1)
+            indices[start:start + block] = np.take_along_axis(nearest, order, axis=1)
+            distances[start:start + block] = np.take_along_axis(nearest_dist, order, axis=1)
+        return indices, distances
+
+    def predict(self, X, k=3):
+        """Label of each row of `X`: the label of its `k` nearest references
+        if they all agree, `unknown` otherwise.
+        """
+        indices, _ = self.query(X, k=k)
+        neighbours = self.labels[indices]
+        agree = np.all(neighbours == neighbours[:, :1], axis=1)
+        try:
+            dtype = np.result_type(neighbours, np.asarray(self.unknown))
+        except TypeError:
+            # e.g. string labels and the default `unknown`
+            dtype = object
+        return np.where(agree, neighbours[:, 0].astype(dtype), np.asarray(self.unknown, dtype=dtype))
+
+    def get_state(self):
+        """Return `(params, arrays)` to store the index without pickling."""
+        params, arrays = self.forest.get_state()
+        arrays = dict(('forest.' + k, v) for k, v in arrays.items())
+        arrays['fingerprints'] = self.fingerprints
+        arrays['labels'] = self.labels
+        return {'forest': params, 'unknown': self.unknown}, arrays
+
+    @classmethod
+    def from_state(cls, params, arrays):
+        forest = FlatForest.from_state(params['forest'], dict(
+            (k[len('forest.'):], v) for k, v in arrays.items() if k.startswith('forest.')))
+        index = cls(forest, unknown=params['unknown'])
+        index._fingerprints = np.asarray(arrays['fingerprints'], dtype=index.dtype)
+        index._labels = np.asarray(arrays['labels'])
+        index.size = len(index._labels)
+        return index
+
+
+def _resized(array, capacity, dtype=None):
+    new_array = np.zeros((capacity,) + array.shape[1:], dtype=dtype or array.dtype)
+    new_array[:len(array)] = array
+    return new_array
@@ -31,26 +31,55 @@
         ./pipeline.py --help
         ./pipeline.py train --help
         ./pipeline.py compose model1 model2 new_model
+        ./pipeline.py compile model compiled_model
+        ./pipeline.py convert model.dump model_dir
+        ./pipeline.py features -t webfp -o website.libsvm traces/
+        ./pipeline.py train --cache-dir ~/.cache/onionpop config.ini
 
 """
+import os
 import sys
 import json
-import dill as pickle
+import time
+import timeit
 import logging
 import argparse
-import pandas as pd
+import importlib
 import numpy as np
 import multiprocessing as mp
 
-from os.path import join, abspath, dirname, pardir, splitext
+from os.path import join, abspath, dirname, pardir, splitext, exists
 
-from sklearn.datasets import load_svmlight_file
+import onionpop.storage
+from onionpop.features import Features
 
-import onionpop.classifiers
-from onionpop.features import Features, test_circuit
+# dill, pandas, scikit-learn and the classifiers module are imported when
+# they are first needed: PrivCount workers that only load a model and
+# predict should not pay for them at startup.
 
 # Global and defaults
 NUM_PROCS = int(mp.cpu_count())
+LOG_LEVELS = ['CRITICAL', 'ERROR', 'WARNING', 'INFO', 'DEBUG']
+
+# `Features` method of each feature set of `extract_dataset`
+FEATURE_SETS = {
+    'purpose': 'extract_purpose_features',
+    'position': 'extract_position_features',
+    'webfp': 'extract_webfp_features',
+    'kfp': 'extract_kfp_features',
+}
+
+# Version of each feature set, part of the keys of the feature cache: bump it
+# when the extraction changes, so that the cached vectors are recomputed
+FEATURE_VERSIONS = {
+    'purpose': 1,
+    'position': 1,
+    'webfp': 1,
+    'kfp': 1,
+}
+
+# Version of the datasets cached by `load_data`
+DATASET_CACHE_VERSION = 2
 
 # Paths
 BASE_DIR = abspath(join(dirname(__file__), pardir))
@@ -65,7 +94,8 @@ def _usage_example():
     model = MiddleEarthModel.load('webfp_fb.model')
 
     # if circuit is *not* Facebook HS with high confidence:
-    features = Features(test_circuit)
+    from onionpop.fixtures import make_test_circuit
+    features = Features(make_test_circuit())
     prediction, confidence = model.predict(features)
     assert prediction == False and confidence > 0.5
 
@@ -81,7 +111,8 @@ def _usage_example_separate_models():
     circuit_model = MiddleEarthModel.load(join(DATA_DIR, 'circuit.model'))
     website_model = MiddleEarthModel.load(join(DATA_DIR, 'website.model'))
 
-    features = Features(test_circuit)
+    from onionpop.fixtures import make_test_circuit
+    features = Features(make_test_circuit())
 
     is_mid_pos, mid_confidence =  position_model.predict(features)
     is_hs, hs_confidence = purpose_model.predict(features)
@@ -90,26 +121,382 @@ def _usage_example_separate_models():
     assert all(is_mid_pos, is_hs, is_fb)
 
 
-def load_data(fpath, sel_feats=None, lab_feat=None):
-    """Loads the dataset in LIBSVM format."""
+def get_classifier(name):
+    """Return the class of the classifier called `name` in
+    `onionpop.classifiers`, importing the module on first use.
+
+    Only `ClassifierInterface` subclasses are accepted, since the name may
+    come from the manifest of a model of unknown origin.
+    """
+    classifiers = importlib.import_module('onionpop.classifiers')
+    clf_class = getattr(classifiers, str(name), None)
+    if not (isinstance(clf_class, type) and issubclass(clf_class, classifiers.ClassifierInterface)):
+        raise ValueError("Unknown classifier: {}".format(name))
+    return clf_class
+
+
+def load_data(fpath, sel_feats=None, lab_feat=None, dtype=np.float64, chunksize=None, cache_dir=None):
+    """Loads the dataset in LIBSVM or CSV format.
+
+    Parameters
+    ----------
+    fpath : str
+        Path to the dataset, `.libsvm`/`.svm` or `.csv`.
+    sel_feats : list of str
+        CSV columns to keep (including the label column).
+    lab_feat : str
+        Name of the label column of CSV files.
+    dtype : numpy dtype
+        Type of the feature values, e.g. `np.float32` to halve memory.
+    chunksize : int
+        If given, the file is read `chunksize` rows at a time with
+        `iter_data` and the chunks are stacked.
+    cache_dir : str
+        Directory of a `onionpop.feature_cache.FeatureCache`. The parsed
+        dataset is stored there, keyed by the content of the file, and
+        later loads of the same content read it memory-mapped instead of
+        parsing the file again.
+
+    Output
+    ------
+        X, y : tup (scipy.sparse.csr_matrix, np.array)
+            Features as a sparse matrix, so that memory scales with the
+            number of non-zero values, and labels.
+    """
+    if cache_dir is not None:
+        return _load_cached_data(fpath, cache_dir, sel_feats=sel_feats, lab_feat=lab_feat,
+                                 dtype=dtype, chunksize=chunksize)
+
+    if chunksize is not None:
+        import scipy.sparse as sp
+        chunks = list(iter_data(fpath, chunksize, sel_feats=sel_feats, lab_feat=lab_feat, dtype=dtype))
+        if not chunks:
+            raise ValueError("Empty dataset: {}".format(fpath))
+        return (sp.vstack([X for X, _ in chunks], format='csr'),
+                np.concatenate([y for _, y in chunks]))
+
     _, ext = splitext(fpath)
     if ext == '.libsvm' or ext == '.svm':
-        return load_svmlight_file(fpath)
+        from sklearn.datasets import load_svmlight_file
+        X, y = load_svmlight_file(fpath, dtype=dtype)
+        # explicit zeros, e.g. the first and last columns of `_libsvm_line`
+        X.eliminate_zeros()
+        return X, y
 
     elif ext == '.csv':
-        data = pd.read_csv(fpath)
-        if sel_feats is not None:
-            data = data[sel_feats]
-        return data[lab_feat], data[[c for c in data.columns if c != lab_feat]]
+        import pandas as pd
+        data = pd.read_csv(fpath, usecols=sel_feats)
+        return _csv_to_sparse(data, lab_feat, dtype)
+
+    elif ext == '.npy':
+        import scipy.sparse as sp
+        X, y = _load_npy(fpath)
+        return sp.csr_matrix(np.asarray(X, dtype=dtype)), np.asarray(y)
+
+    else:
+        raise Exception("Unrecognized extension: {}".format(ext))
+
 
+def _load_cached_data(fpath, cache_dir, sel_feats=None, lab_feat=None, dtype=np.float64, chunksize=None):
+    """`load_data` through the feature cache."""
+    import scipy.sparse as sp
+    from onionpop.feature_cache import FeatureCache, file_digest
+
+    logger = logging.getLogger()
+    cache = FeatureCache(cache_dir)
+    ext = splitext(fpath)[1]
+    # the labels of a `.npy` dataset are in another file
+    labels_digest = file_digest(_labels_path(fpath)) if ext == '.npy' else None
+    # the chunk size does not change the result, so it is not part of the key
+    key = cache.key(file_digest(fpath), labels_digest, ext, DATASET_CACHE_VERSION,
+                    np.dtype(dtype).name, sel_feats, lab_feat)
+    arrays = cache.get('datasets', key)
+    if arrays is not None:
+        logger.debug("Loaded {} from the feature cache.".format(fpath))
+        X = sp.csr_matrix((arrays['data'], arrays['indices'], arrays['indptr']),
+                          shape=tuple(int(n) for n in arrays['shape']))
+        return X, arrays['labels']
+
+    X, y = load_data(fpath, sel_feats=sel_feats, lab_feat=lab_feat, dtype=dtype, chunksize=chunksize)
+    X = sp.csr_matrix(X)
+    y = np.asarray(y)
+    if y.dtype == object:
+        # labels that cannot be stored without pickling
+        logger.debug("Not caching {}: unsupported labels.".format(fpath))
     else:
+        cache.put('datasets', key, {'data': X.data, 'indices': X.indices, 'indptr': X.indptr,
+                                    'shape': np.array(X.shape), 'labels': y})
+    return X, y
+
+
+def iter_data(fpath, chunksize, sel_feats=None, lab_feat=None, dtype=np.float64):
+    """Read a LIBSVM or CSV dataset `chunksize` rows at a time.
+
+    Yields `(X, y)` pairs like `load_data`. All the chunks of a file have the
+    same number of columns.
+    """
+    _, ext = splitext(fpath)
+    if ext == '.libsvm' or ext == '.svm':
+        from io import BytesIO
+        from itertools import islice
+        from sklearn.datasets import load_svmlight_file
+
+        # the number of features and the index base must be known upfront,
+        # as a single chunk does not necessarily show them
+        n_features, zero_based = _libsvm_layout(fpath)
+        with open(fpath, 'rb') as fi:
+            while True:
+                lines = list(islice(fi, chunksize))
+                if not lines:
+                    break
+                X, y = load_svmlight_file(BytesIO(b''.join(lines)), n_features=n_features,
+                                          dtype=dtype, zero_based=zero_based)
+                X.eliminate_zeros()
+                yield X, y
+
+    elif ext == '.csv':
+        import pandas as pd
+        for data in pd.read_csv(fpath, usecols=sel_feats, chunksize=chunksize):
+            yield _csv_to_sparse(data, lab_feat, dtype)
+
+    elif ext == '.npy':
+        import scipy.sparse as sp
+        X, y = _load_npy(fpath)
+        for start in range(0, len(y), chunksize):
+            yield (sp.csr_matrix(np.asarray(X[start:start + chunksize], dtype=dtype)),
+                   np.asarray(y[start:start + chunksize]))
+
+    else:
+        raise Exception("Unrecognized extension: {}".format(ext))
+
+
+def _libsvm_layout(fpath):
+    """Return the number of features of a LIBSVM file and whether its
+    feature indices start at zero.
+    """
+    min_index = None
+    max_index = -1
+    with open(fpath, 'rb') as fi:
+        for line in fi:
+            line = line.split(b'#', 1)[0]
+            for token in line.split()[1:]:
+                name = token.split(b':', 1)[0]
+                if name == b'qid':
+                    continue
+                index = int(name)
+                max_index = max(max_index, index)
+                min_index = index if min_index is None else min(min_index, index)
+    zero_based = min_index == 0
+    return (max_index + 1 if zero_based else max(max_index, 0)), zero_based
+
+
+def _labels_path(fpath):
+    """Labels of a `.npy` dataset: "<name>.npy" goes with "<name>.labels.npy"."""
+    return splitext(fpath)[0] + '.labels.npy'
+
+
+def _load_npy(fpath):
+    """Memory-mapped features and labels of a `.npy` dataset."""
+    return (np.load(fpath, mmap_mode='r', allow_pickle=False),
+            np.load(_labels_path(fpath), allow_pickle=False))
+
+
+def _extract_item(job):
+    """Parse a circuit of `onionpop.traces.iter_items` and extract its
+    features (in a worker process of `extract_dataset`).
+
+    With a cache, the features are looked up by the content of the item and
+    the version of the feature set, and only computed on a miss.
+    """
+    import onionpop.traces
+    (kind, payload, source), feature_set, cache_dir = job
+    if cache_dir is None:
+        label, circuit_id, circuit = onionpop.traces.parse_item(kind, payload)
+        return source, label, circuit_id, _extract_vector(circuit, feature_set), False
+
+    from onionpop.feature_cache import FeatureCache
+    # the vectors are small: read them in memory
+    cache = FeatureCache(cache_dir, mmap_mode=None)
+    content = onionpop.traces.item_content(kind, payload)
+    key = cache.key(kind, content, feature_set, FEATURE_VERSIONS[feature_set])
+    arrays = cache.get('features', key)
+    if arrays is not None:
+        label, circuit_id = onionpop.traces.item_label(kind, payload, content)
+        # an empty vector stands for a circuit without features
+        vector = arrays['vector'].tolist() or None
+        return source, label, circuit_id, vector, True
+
+    label, circuit_id, circuit = onionpop.traces.parse_item(kind, payload, content)
+    vector = _extract_vector(circuit, feature_set)
+    cache.put('features', key, {'vector': np.array(vector if vector is not None else [], dtype=np.float64)})
+    return source, label, circuit_id, vector, False
+
+
+def _extract_vector(circuit, feature_set):
+    features = Features(circuit)
+    if feature_set in ('webfp', 'kfp') and len(features.get_cell_arrays()[1]) == 0:
+        # the website features of a trace without client-side cells
+        return None
+    try:
+        vector = getattr(features, FEATURE_SETS[feature_set])()
+    except ValueError:
+        # e.g., a circuit without cells
+        return None
+    if vector is None:
+        return None
+    return [float(v) for v in vector]
+
+
+def _libsvm_line(label, vector, comment=None):
+    """LIBSVM line of a feature vector, without its zeros like
+    `dump_svmlight_file`. The first and last columns are always written, so
+    that the file reads back zero-based and with all the columns.
+    """
+    last = len(vector) - 1
+    values = ' '.join("{}:{}".format(i, int(v) if v == int(v) else repr(v))
+                      for i, v in enumerate(vector) if v != 0 or i == 0 or i == last)
+    line = "{} {}".format(0 if label is None else label, values)
+    if comment is not None:
+        line += " # {}".format(comment)
+    return line + "\n"
+
+
+def extract_dataset(inputs, feature_set, output, jobs=1, chunksize=16, progress_every=10.0, cache_dir=None):
+    """Build a training dataset from captured circuits or traces.
+
+    The circuits are read from disk as they are needed (see
+    `onionpop.traces` for the formats), parsed and featurized by a pool of
+    `jobs` processes, and written in input order as they are featurized,
+    so that memory does not grow with the number of circuits.
+
+    Parameters
+    ----------
+    inputs : list of str
+        Circuit files (`.jsonl`), trace files or directories of them.
+    feature_set : str
+        One of `FEATURE_SETS`. Trace files only have what `webfp` and
+        `kfp` need.
+    output : str
+        `.libsvm`/`.svm` file, with the circuit id as a comment on every
+        line, or `.npy` file, with the labels in "<name>.labels.npy".
+        Circuits without a label get label 0.
+    jobs : int
+        Number of processes.
+    chunksize : int
+        Number of circuits sent to a worker at a time.
+    progress_every : float
+        Seconds between two progress messages.
+    cache_dir : str
+        Directory of a `onionpop.feature_cache.FeatureCache`. The features of
+        every circuit are cached by content and feature set version, so that
+        a new run only computes those of new or changed circuits.
+
+    Output
+    ------
+        num_written, num_skipped : tup (int, int)
+            Circuits written and circuits without features (e.g., empty).
+    """
+    import onionpop.traces
+    if feature_set not in FEATURE_SETS:
+        raise ValueError("Unknown feature set: {}".format(feature_set))
+    _, ext = splitext(output)
+    if ext not in ('.libsvm', '.svm', '.npy'):
         raise Exception("Unrecognized extension: {}".format(ext))
 
+    logger = logging.getLogger()
+    jobs_iter = ((item, feature_set, cache_dir) for item in onionpop.traces.iter_items(inputs))
+    pool = mp.Pool(jobs) if jobs > 1 else None
+    results = pool.imap(_extract_item, jobs_iter, chunksize) if pool is not None else map(_extract_item, jobs_iter)
+
+    num_written = num_skipped = num_cached = 0
+    num_columns = None
+    labels = []
+    start = last_report = time.time()
+    # `.npy` rows are appended to a raw file and wrapped at the end
+    raw_path = output + '.tmp'
+    fo = open(output, 'w') if ext != '.npy' else open(raw_path, 'wb')
+    failed = True
+    try:
+        for source, label, circuit_id, vector, cached in results:
+            num_cached += cached
+            if vector is None:
+                num_skipped += 1
+                logger.debug("No {} features for {}.".format(feature_set, source))
+                continue
+            if ext != '.npy':
+                fo.write(_libsvm_line(label, vector, circuit_id))
+            else:
+                if num_columns is None:
+                    num_columns = len(vector)
+                elif len(vector) != num_columns:
+                    raise ValueError("{} has {} features instead of {}.".format(source, len(vector), num_columns))
+                np.asarray(vector, dtype=np.float64).tofile(fo)
+                labels.append(0 if label is None else label)
+            num_written += 1
+
+            now = time.time()
+            if now - last_report >= progress_every:
+                last_report = now
+                logger.info("{} circuits featurized ({:.1f}/s), {} skipped.".format(
+                    num_written, num_written / (now - start), num_skipped))
+
+        if ext == '.npy':
+            fo.close()
+            _raw_to_npy(raw_path, output, (num_written, num_columns or 0))
+            np.save(_labels_path(output), np.array(labels), allow_pickle=False)
+        failed = False
+    finally:
+        fo.close()
+        if pool is not None:
+            if failed:
+                # do not wait for the workers to featurize the rest of the inputs
+                pool.terminate()
+            else:
+                pool.close()
+            pool.join()
+        if ext == '.npy' and exists(raw_path):
+            os.remove(raw_path)
+
+    elapsed = max(time.time() - start, 1e-9)
+    logger.info("Wrote {} circuits to {} in {:.1f}s ({:.1f}/s), {} skipped.".format(
+        num_written, output, elapsed, num_written / elapsed, num_skipped))
+    if cache_dir is not None:
+        logger.info("{} circuits read from the feature cache.".format(num_cached))
+    return num_written, num_skipped
+
+
+def _raw_to_npy(raw_path, output, shape, block_size=1 << 24):
+    """Write the float64 rows of a raw file as a `.npy` file, `block_size`
+    bytes at a time.
+    """
+    if not shape[0]:
+        np.save(output, np.zeros(shape), allow_pickle=False)
+        return
+    raw = np.memmap(raw_path, dtype=np.float64, mode='r', shape=shape)
+    out = np.lib.format.open_memmap(output, mode='w+', dtype=np.float64, shape=shape)
+    block_rows = max(1, block_size // (8 * shape[1]))
+    for start in range(0, shape[0], block_rows):
+        out[start:start + block_rows] = raw[start:start + block_rows]
+    out.flush()
+    del raw, out
+
+
+def _csv_to_sparse(data, lab_feat, dtype):
+    import scipy.sparse as sp
+    if lab_feat is None:
+        raise ValueError("The label column of CSV datasets must be specified.")
+    X = data[[c for c in data.columns if c != lab_feat]].values.astype(dtype)
+    return sp.csr_matrix(X), data[lab_feat].values
+
 
 class Model(object):
     """This class implements a model passed to the API."""
 
     _clf = None
+    dtype = 'float64'
+    chunksize = None
+    cache_dir = None
+    label = None
 
     def __init__(self, config):
         #log.info("New model: {classifier} with data {dataset}. Params = {params}".format(**config))
@@ -117,8 +504,15 @@ class Model(object):
         # define path to dataset
         self.data_path = config['dataset']
 
+        # optional: feature type, number of rows read at a time, feature
+        # cache of the parsed dataset and label column of CSV datasets
+        self.dtype = config.get('dtype', 'float64')
+        self.chunksize = config.get('chunksize')
+        self.cache_dir = config.get('cache_dir')
+        self.label = config.get('label')
+
         # instantiate the classifier
-        self._clf = getattr(onionpop.classifiers, config['classifier'])(**config['params'])
+        self._clf = get_classifier(config['classifier'])(**config['params'])
 
     def dump(self, fpath):
         """Dump the model to a file for later use.
@@ -128,21 +522,47 @@ class Model(object):
         fpath : str
             Path to file where model will be dumped.
         """
+        import dill as pickle
         with open(fpath, 'wb') as fo:
             pickle.dump(self, fo)
 
+    def compile(self):
+        """Drop the training backend of classifiers that can predict
+        without it (see `classifiers.ForestClassifierInterface.compile`).
+        """
+        if hasattr(self._clf, 'compile'):
+            self._clf.compile()
+
     def predict(self, features):
         if self._clf is None:
             raise Exception("The model has not been trained.")
         return self._clf.predict(features)
 
+    def predict_many(self, features_list):
+        if self._clf is None:
+            raise Exception("The model has not been trained.")
+        return self._clf.predict_many(features_list)
+
+    def set_n_jobs(self, n_jobs):
+        """Number of parallel jobs the classifier may use for training."""
+        self._clf.set_n_jobs(n_jobs)
+
     def train(self):
         """Train the model."""
-        X, y = load_data(self.data_path)
-        X = np.asarray(X.todense())
+        X, y = load_data(self.data_path, lab_feat=self.label, dtype=np.dtype(self.dtype),
+                         chunksize=self.chunksize, cache_dir=self.cache_dir)
+        # keep the data sparse for the classifiers that take it
+        if not self._clf.accepts_sparse:
+            X = X.toarray()
         self._clf.train(X, y)
 
 
+def _train_model(model):
+    """Train a model in a worker process and send it back."""
+    model.train()
+    return model
+
+
 class MiddleEarthModel(Model):
     """This class implements a composite model for the pipeline.
 
@@ -152,6 +572,9 @@ class MiddleEarthModel(Model):
     (load, dump) in a more simple manner.
     """
     _models = None
+    # see `set_instrumentation` and `set_scheduler`
+    _instrumentation = None
+    _scheduler = None
 
     def __init__(self):
         self._models = []
@@ -164,22 +587,138 @@ class MiddleEarthModel(Model):
         """Return last model in the list."""
         return self._models.pop()
 
+    def compile(self):
+        """Drop the training backend of every model (see `Model.compile`).
+
+        Only scikit-learn forests can be flattened: a `ValueError` naming the
+        stage is raised for Pyborist forests.
+        """
+        for i, model in enumerate(self._models):
+            try:
+                model.compile()
+            except ValueError as e:
+                raise ValueError("Stage {} cannot be compiled: {}".format(self._stage_name(i), e))
+
+    def set_instrumentation(self, instrumentation):
+        """Record per-stage counters and latencies of the predictions.
+
+        Parameters
+        ----------
+        instrumentation : onionpop.instrumentation.PipelineStats
+            Or any object with the same `record_stage`, `record_prediction`
+            and `snapshot` methods. Stages are named `<index>.<classifier>`.
+            None disables the instrumentation.
+        """
+        self._instrumentation = instrumentation
+
+    def stats(self):
+        """Return a snapshot of the instrumentation, or None if disabled."""
+        if self._instrumentation is None:
+            return None
+        return self._instrumentation.snapshot()
+
+    def set_scheduler(self, scheduler):
+        """Let `predict` evaluate the models in an adaptive order.
+
+        The scheduler may only reorder the models within each of the
+        `stage_groups`, so the output of `predict` is unchanged.
+
+        Parameters
+        ----------
+        scheduler : onionpop.scheduler.AdaptiveScheduler
+            None restores the pipeline order.
+        """
+        if scheduler is not None:
+            scheduler.set_groups(self.stage_groups())
+        self._scheduler = scheduler
+
+    def stage_groups(self):
+        """Groups of consecutive stages that can be evaluated in any order.
+
+        Stages whose classifier is `reorderable` (its confidence is always
+        1.0) are grouped with their reorderable neighbours; every other
+        stage is a group of its own, so that it keeps its position and the
+        confidences before a rejection are those of `predict`.
+        """
+        groups = []
+        previous_reorderable = False
+        for i, model in enumerate(self._models):
+            reorderable = bool(getattr(model._clf, 'reorderable', False))
+            if reorderable and previous_reorderable:
+                groups[-1].append(i)
+            else:
+                groups.append([i])
+            previous_reorderable = reorderable
+        return groups
+
+    def _stage_name(self, index):
+        return '{}.{}'.format(index, type(self._models[index]._clf).__name__)
+
+    def save(self, dirpath):
+        """Store the model in the pickle-free format of `onionpop.storage`.
+
+        Forests must have been trained with the sklearn backend: Pyborist
+        forests cannot be flattened, and a `ValueError` naming the stage is
+        raised.
+
+        Parameters
+        ----------
+        dirpath : str
+            Directory where the model will be stored.
+        """
+        entries = []
+        for i, model in enumerate(self._models):
+            try:
+                params, arrays = model._clf.get_state()
+            except ValueError as e:
+                raise ValueError("Stage {} cannot be stored: {}".format(self._stage_name(i), e))
+            entries.append({'classifier': type(model._clf).__name__,
+                            'dataset': model.data_path,
+                            'params': params,
+                            'arrays': arrays})
+        onionpop.storage.save(dirpath, entries)
+
     @staticmethod
-    def load(fpath):
+    def load(fpath, mmap_mode='r'):
         """Load an already-trained model.
 
         Parameters
         ----------
         fpath : str
-            Path to file where model has been dumped.
+            Path to file where model has been dumped, or to the directory
+            where it has been saved with `save`.
+        mmap_mode : str
+            Memory-map mode of the arrays of saved models (see `np.load`).
         """
+        if onionpop.storage.is_model_dir(fpath):
+            comp_model = MiddleEarthModel()
+            for entry in onionpop.storage.load(fpath, mmap_mode=mmap_mode):
+                clf_class = get_classifier(entry['classifier'])
+                model = Model.__new__(Model)
+                model.data_path = entry['dataset']
+                model._clf = clf_class.from_state(entry['params'], entry['arrays'])
+                comp_model.add(model)
+            return comp_model
+
+        import dill as pickle
         with open(fpath, 'rb') as fi:
             return pickle.load(fi)
 
     @classmethod
-    def train(cls, config_file):
+    def train(cls, config_file, jobs=1, cache_dir=None):
         """Return a model trained as specified in the config file.
 
+        Parameters
+        ----------
+        config_file : str
+            Path to the configuration file.
+        jobs : int
+            Number of processes. The models are trained concurrently, and
+            the processes left over are passed down to the classifiers that
+            can train in parallel.
+        cache_dir : str
+            Feature cache of the datasets (see `load_data`), for the models
+            that do not set their own `cache_dir`.
         """
         comp_model = cls()
 
@@ -187,10 +726,26 @@ class MiddleEarthModel(Model):
         for line in open(config_file):
             if line.strip().startswith('#') or not line.strip():
                 continue
-            comp_model.add(Model(json.loads(line.strip())))
+            model = Model(json.loads(line.strip()))
+            if model.cache_dir is None:
+                model.cache_dir = cache_dir
+            comp_model.add(model)
 
         # train models
-        map(lambda m: m.train(), comp_model._models)
+        num_models = len(comp_model._models)
+        for model in comp_model._models:
+            model.set_n_jobs(max(1, jobs // max(1, num_models)))
+
+        if jobs > 1 and num_models > 1:
+            pool = mp.Pool(min(jobs, num_models))
+            try:
+                comp_model._models = pool.map(_train_model, comp_model._models)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            for model in comp_model._models:
+                model.train()
 
         return comp_model
 
@@ -210,9 +765,30 @@ class MiddleEarthModel(Model):
                 - `confidence` is the probability that prediction is true
                 according to the classifier's estimation.
         """
-        overall_confidence = 1.0
+        if self._scheduler is not None:
+            return self._predict_adaptive(features)
+        return self.predict_stages(features)
+
+    def predict_stages(self, features, start=0, stop=None, confidence=1.0):
+        """Run the models `start:stop` of the pipeline, as `predict` does.
 
-        for model in self._models:
+        Used to classify a circuit in several steps (see `onionpop.streaming`):
+        the result of a first call is final if the circuit was rejected,
+        otherwise its confidence is passed to the call for the next models.
+
+        Parameters
+        ----------
+        start, stop : int
+            Slice of the models to run.
+        confidence : float
+            Overall confidence of the models before `start`.
+        """
+        if self._instrumentation is not None:
+            return self._predict_instrumented(features, start, stop, confidence)
+
+        overall_confidence = confidence
+
+        for model in self._models[start:stop]:
             is_detected, confidence = model.predict(features)
 
             if not is_detected:  # early stop
@@ -222,6 +798,161 @@ class MiddleEarthModel(Model):
 
         return True, overall_confidence
 
+    def _predict_instrumented(self, features, start, stop, overall_confidence):
+        """`predict_stages`, timing feature extraction and inference separately.
+
+        A prediction is recorded once the circuit is rejected or has been
+        through the last model.
+        """
+        instrumentation = self._instrumentation
+        t_start = timeit.default_timer()
+        stop = len(self._models) if stop is None else stop
+        result = None
+
+        for i in range(start, stop):
+            model = self._models[i]
+            if model._clf is None:
+                raise Exception("The model has not been trained.")
+            t0 = timeit.default_timer()
+            feature_vector = model._clf.extract_features(features)
+            t1 = timeit.default_timer()
+            is_detected, confidence = model._clf.predict_with_confidence(feature_vector)
+            t2 = timeit.default_timer()
+            instrumentation.record_stage(self._stage_name(i), 1, t1 - t0, t2 - t1, 0 if is_detected else 1)
+
+            if not is_detected:  # early stop
+                result = (False, overall_confidence)
+                break
+
+            overall_confidence *= confidence  # error accumulates
+        else:
+            result = (True, overall_confidence)
+
+        if not result[0] or stop >= len(self._models):
+            instrumentation.record_prediction(1, timeit.default_timer() - t_start, 0 if result[0] else 1)
+        return result
+
+    def _predict_adaptive(self, features):
+        """`predict`, in the order of the scheduler.
+
+        Stages are only reordered within groups of stages whose confidence
+        is always 1.0 (see `stage_groups`): whichever of them rejects a
+        circuit, the output is the same. A stage moved ahead of an earlier
+        one may still fail on circuits that the earlier one rejects (e.g.
+        website features of a circuit without client-side cells); the rest
+        of its group is then evaluated in pipeline order, which raises only
+        if `predict` would.
+        """
+        scheduler = self._scheduler
+        instrumentation = self._instrumentation
+        t_start = timeit.default_timer()
+        confidences = [None] * len(self._models)
+
+        def evaluate(i):
+            model = self._models[i]
+            if model._clf is None:
+                raise Exception("The model has not been trained.")
+            t0 = timeit.default_timer()
+            feature_vector = model._clf.extract_features(features)
+            t1 = timeit.default_timer()
+            is_detected, confidence = model._clf.predict_with_confidence(feature_vector)
+            t2 = timeit.default_timer()
+            scheduler.record(i, t2 - t0, is_detected)
+            if instrumentation is not None:
+                instrumentation.record_stage(self._stage_name(i), 1, t1 - t0, t2 - t1, 0 if is_detected else 1)
+            if is_detected:
+                confidences[i] = confidence
+            return is_detected
+
+        def passes(group):
+            for n, i in enumerate(group):
+                try:
+                    if not evaluate(i):
+                        return False
+                except Exception:
+                    remaining = sorted(group[n:])
+                    if remaining[0] == i:
+                        # it comes first in pipeline order too
+                        raise
+                    for j in remaining:
+                        if not evaluate(j):
+                            return False
+                    return True
+            return True
+
+        result = None
+        overall_confidence = 1.0
+        for group in scheduler.group_orders:
+            if not passes(group):
+                result = (False, overall_confidence)
+                break
+            # the confidences are multiplied in pipeline order, as in `predict`
+            for i in sorted(group):
+                overall_confidence *= confidences[i]
+        else:
+            result = (True, overall_confidence)
+
+        scheduler.prediction_done()
+        if instrumentation is not None:
+            instrumentation.record_prediction(1, timeit.default_timer() - t_start, 0 if result[0] else 1)
+        return result
+
+    def predict_many(self, features_list):
+        """Return prediction results for a batch of circuits.
+
+        Equivalent to calling `predict` on each element of `features_list`,
+        but every model in the pipeline is evaluated once on a matrix with
+        the circuits that are still alive. Circuits rejected by a model are
+        masked out and never reach the following models.
+
+        Output
+        ------
+            predictions, confidences : tup (np.array of bool, np.array of float)
+                One entry per circuit, in the same order as `features_list`.
+        """
+        instrumentation = self._instrumentation
+        if instrumentation is not None:
+            start = timeit.default_timer()
+
+        num_circuits = len(features_list)
+        predictions = np.ones(num_circuits, dtype=bool)
+        overall_confidences = np.ones(num_circuits)
+        alive = np.ones(num_circuits, dtype=bool)
+
+        for stage, model in enumerate(self._models):
+            alive_idx = np.flatnonzero(alive)
+            if len(alive_idx) == 0:
+                break
+
+            alive_features = [features_list[i] for i in alive_idx]
+            if instrumentation is None:
+                is_detected, confidences = model.predict_many(alive_features)
+            else:
+                if model._clf is None:
+                    raise Exception("The model has not been trained.")
+                t0 = timeit.default_timer()
+                feature_matrix = model._clf.extract_feature_matrix(alive_features)
+                t1 = timeit.default_timer()
+                is_detected, confidences = model._clf.predict_many_with_confidence(feature_matrix)
+                t2 = timeit.default_timer()
+                instrumentation.record_stage(self._stage_name(stage), len(alive_idx), t1 - t0, t2 - t1,
+                                             len(alive_idx) - int(np.count_nonzero(is_detected)))
+            is_detected = np.asarray(is_detected, dtype=bool)
+
+            # early stop for the rejected circuits
+            rejected_idx = alive_idx[~is_detected]
+            predictions[rejected_idx] = False
+            alive[rejected_idx] = False
+
+            # error accumulates for the survivors
+            detected_idx = alive_idx[is_detected]
+            overall_confidences[detected_idx] *= np.asarray(confidences)[is_detected]
+
+        if instrumentation is not None and num_circuits:
+            instrumentation.record_prediction(num_circuits, timeit.default_timer() - start,
+                                              num_circuits - int(np.count_nonzero(predictions)))
+        return predictions, overall_confidences
+
 
 def main():
     parser = get_parser()
@@ -246,9 +977,30 @@ def main():
 
         new_model.dump(args.models[-1])
 
+    elif args.action == 'convert':
+        model = MiddleEarthModel.load(args.model)
+        try:
+            model.save(args.output)
+        except ValueError as e:
+            log.error(str(e))
+            return 1
+
+    elif args.action == 'compile':
+        model = MiddleEarthModel.load(args.model)
+        try:
+            model.compile()
+        except ValueError as e:
+            log.error(str(e))
+            return 1
+        model.dump(args.output)
+
+    elif args.action == 'features':
+        extract_dataset(args.inputs, args.type, args.output, jobs=args.jobs, chunksize=args.chunksize,
+                        cache_dir=args.cache_dir)
+
     elif args.action == 'train':
         # train the model
-        model = MiddleEarthModel.train(args.configfile)
+        model = MiddleEarthModel.train(args.configfile, jobs=args.jobs, cache_dir=args.cache_dir)
 
         # dump model?
         if args.output:
@@ -275,7 +1027,7 @@ def get_parser():
                         type=str,
                         dest="loglevel",
                         metavar='<log level>',
-                        choices=[l for l in logging._levelNames if type(l) is str],
+                        choices=LOG_LEVELS,
                         default=logging.getLevelName(logging.INFO),
                         help='logging verbosity level.')
 
@@ -292,11 +1044,69 @@ def get_parser():
                               type=str,
                               metavar='output file',
                               help='path where model should be dumped.')
+
+    train_parser.add_argument('-j', '--jobs',
+                              type=int,
+                              default=NUM_PROCS,
+                              metavar='<jobs>',
+                              help='number of processes used to train the models.')
+
+    train_parser.add_argument('--cache-dir',
+                              type=str,
+                              metavar='<cache dir>',
+                              help='feature cache of the parsed datasets.')
     comps_parser = subparsers.add_parser('compose', help="Compose multiple models into one single model.")
     comps_parser.add_argument('models',
                               nargs='+',
                               metavar='<model1> <model2> <new model>',
                               help='configuration file that specifies the pipeline.')
+    convert_parser = subparsers.add_parser('convert', help="Convert a dill model into the pickle-free model format.")
+    convert_parser.add_argument('model',
+                                type=str,
+                                metavar='<model>',
+                                help='path to the dill model.')
+    convert_parser.add_argument('output',
+                                type=str,
+                                metavar='<model dir>',
+                                help='directory where the converted model should be saved.')
+    features_parser = subparsers.add_parser('features', help="Build a training dataset from captured circuits or traces.")
+    features_parser.add_argument('inputs',
+                                 nargs='+',
+                                 metavar='<input>',
+                                 help='circuit files (.jsonl), trace files or directories of them.')
+    features_parser.add_argument('-t', '--type',
+                                 type=str,
+                                 required=True,
+                                 choices=sorted(FEATURE_SETS),
+                                 help='features to extract.')
+    features_parser.add_argument('-o', '--output',
+                                 type=str,
+                                 required=True,
+                                 metavar='<dataset>',
+                                 help='output dataset, .libsvm or .npy.')
+    features_parser.add_argument('-j', '--jobs',
+                                 type=int,
+                                 default=NUM_PROCS,
+                                 metavar='<jobs>',
+                                 help='number of processes.')
+    features_parser.add_argument('--chunksize',
+                                 type=int,
+                                 default=16,
+                                 metavar='<circuits>',
+                                 help='circuits sent to a process at a time.')
+    features_parser.add_argument('--cache-dir',
+                                 type=str,
+                                 metavar='<cache dir>',
+                                 help='feature cache of the extracted circuits.')
+    compile_parser = subparsers.add_parser('compile', help="Flatten the scikit-learn forests of a model so it can be used without scikit-learn.")
+    compile_parser.add_argument('model',
+                                type=str,
+                                metavar='<model>',
+                                help='path to the trained model.')
+    compile_parser.add_argument('output',
+                                type=str,
+                                metavar='<compiled model>',
+                                help='path where the compiled model should be dumped.')
 
     return parser
 
@@ -318,7 +1128,7 @@ def config_logger(args):
     log.addHandler(ch)
 
     # Set level format
-    log.setLevel(logging._levelNames[args.loglevel])
+    log.setLevel(args.loglevel)
 
 
 if __name__ == "__main__":
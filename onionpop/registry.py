@@ -0,0 +1,191 @@
+"""
+    `registry.py`
+
+    Routes the cells seen by a relay to their circuits, with bounded memory.
+
+        registry = CircuitRegistry(on_finished=classify, idle_timeout=60,
+                                   max_cells=10 ** 7, max_cells_per_circuit=5000)
+        for cell in cells:
+            registry.add_cell(cell)
+        registry.close()
+
+    Circuits are keyed by `(chan_id, circ_id)` and are finished when the
+    relay sends a DESTROY cell (it forwards the DESTROY it received from one
+    side, which is the last cell of the circuit), when they have been idle
+    for `idle_timeout` seconds or when they are evicted to stay within the
+    budgets. Finished circuits are removed from the registry and passed to
+    `on_finished(circuit, reason)`.
+
+    Time is taken from the cell timestamps, so that traces can be replayed
+    faster than real time.
+"""
+import sys
+
+from collections import OrderedDict
+
+from onionpop.features import Circuit, DESTROY_TYPE
+
+# reasons passed to `on_finished`
+DESTROYED = 'destroyed'
+IDLE = 'idle'
+EVICTED = 'evicted'
+CLOSED = 'closed'
+
+
+class CircuitRegistry(object):
+    """Live circuits, indexed by `(chan_id, circ_id)`.
+
+    Parameters
+    ----------
+    on_finished : callable
+        Called as `on_finished(circuit, reason)` for every finished circuit.
+    idle_timeout : float
+        Seconds without cells after which a circuit is finished. None
+        disables the timeout.
+    max_circuits : int
+        Maximum number of live circuits.
+    max_cells : int
+        Maximum number of cells stored over all the live circuits.
+    max_cells_per_circuit : int
+        Cells stored per circuit. Later cells are still counted (so the
+        purpose and position features stay exact) but not stored.
+    eviction : str
+        'oldest' evicts the least recently active circuit, 'largest' the
+        circuit with the most stored cells.
+    """
+
+    def __init__(self, on_finished=None, idle_timeout=None, max_circuits=None, max_cells=None,
+                 max_cells_per_circuit=None, eviction='oldest'):
+        if eviction not in ('oldest', 'largest'):
+            raise ValueError("Unknown eviction policy: {}".format(eviction))
+        self.on_finished = on_finished
+        self.idle_timeout = idle_timeout
+        self.max_circuits = max_circuits
+        self.max_cells = max_cells
+        self.max_cells_per_circuit = max_cells_per_circuit
+        self.eviction = eviction
+
+        # least recently active first
+        self._circuits = OrderedDict()
+        self._last_seen = {}
+        self.num_cells = 0  # stored cells over all the live circuits
+        self.now = None
+        self.finished = dict((reason, 0) for reason in (DESTROYED, IDLE, EVICTED, CLOSED))
+
+    def __len__(self):
+        return len(self._circuits)
+
+    def __contains__(self, key):
+        return key in self._circuits
+
+    def get(self, chan_id, circ_id):
+        return self._circuits.get((chan_id, circ_id))
+
+    def open(self, chan_id, circ_id, prev_node=None, next_node=None):
+        """Register a circuit and return it.
+
+        Circuits of unknown cells are opened implicitly, without nodes; call
+        this first to set the previous and next nodes.
+        """
+        key = (chan_id, circ_id)
+        circuit = self._circuits.get(key)
+        if circuit is None:
+            circuit = Circuit(chan_id, circ_id, prev_node, next_node)
+            self._circuits[key] = circuit
+            self._last_seen[key] = self.now
+            self._enforce_budgets()
+        else:
+            circuit.prev_node = prev_node or circuit.prev_node
+            circuit.next_node = next_node or circuit.next_node
+        return circuit
+
+    def add_cell(self, cell):
+        """Route `cell` to its circuit, finishing it on a sent DESTROY."""
+        if self.now is None or cell.timestamp > self.now:
+            self.now = cell.timestamp
+        self.expire()
+
+        key = (cell.chan_id, cell.circ_id)
+        circuit = self._circuits.pop(key, None)
+        if circuit is None:
+            circuit = Circuit(cell.chan_id, cell.circ_id, None, None)
+        # re-inserted last: most recently active
+        self._circuits[key] = circuit
+        self._last_seen[key] = self.now
+
+        if self.max_cells_per_circuit is not None and circuit.num_cells >= self.max_cells_per_circuit:
+            circuit.store_cells = False
+        num_cells = circuit.num_cells
+        circuit.add_cell(cell)
+        self.num_cells += circuit.num_cells - num_cells
+
+        if cell.ctype_code == DESTROY_TYPE and cell.is_sent:
+            self._finish(key, DESTROYED)
+        else:
+            self._enforce_budgets()
+
+    def release_cells(self, circuit):
+        """Free the cells stored by a live circuit (see `Circuit.release_cells`)."""
+        self.num_cells -= circuit.num_cells
+        circuit.release_cells()
+
+    def expire(self, now=None):
+        """Finish the circuits idle since `idle_timeout` seconds before `now`
+        (by default, the latest cell timestamp).
+        """
+        if self.idle_timeout is None:
+            return
+        if now is not None and (self.now is None or now > self.now):
+            self.now = now
+        if self.now is None:
+            return
+        deadline = self.now - self.idle_timeout
+        while self._circuits:
+            key = next(iter(self._circuits))
+            last_seen = self._last_seen[key]
+            if last_seen is None:
+                # opened before any cell was seen: start its clock now
+                self._circuits[key] = self._circuits.pop(key)
+                self._last_seen[key] = self.now
+            elif last_seen > deadline:
+                break
+            else:
+                self._finish(key, IDLE)
+
+    def close(self):
+        """Finish all the live circuits."""
+        for key in list(self._circuits):
+            self._finish(key, CLOSED)
+
+    def _enforce_budgets(self):
+        while self._circuits and (
+                (self.max_circuits is not None and len(self._circuits) > self.max_circuits) or
+                (self.max_cells is not None and self.num_cells > self.max_cells)):
+            if self.eviction == 'oldest':
+                key = next(iter(self._circuits))
+            else:
+                key = max(self._circuits, key=lambda k: self._circuits[k].num_cells)
+            self._finish(key, EVICTED)
+
+    def _finish(self, key, reason):
+        circuit = self._circuits.pop(key)
+        del self._last_seen[key]
+        self.num_cells -= circuit.num_cells
+        self.finished[reason] += 1
+        if self.on_finished is not None:
+            self.on_finished(circuit, reason)
+
+    def memory_footprint(self):
+        """Return the number of live circuits, of stored cells, the bytes used
+        by the cell columns of the live circuits (`column_bytes`) and an
+        estimate of all the bytes held for them, including the fixed cost
+        of every circuit and the registry's indexes (`bytes`).
+        """
+        circuits = self._circuits
+        num_bytes = sys.getsizeof(circuits) + sys.getsizeof(self._last_seen)
+        for key, circuit in circuits.items():
+            num_bytes += sys.getsizeof(key) + circuit.memory_size()
+        return {'circuits': len(circuits),
+                'cells': self.num_cells,
+                'column_bytes': sum(c.nbytes for c in circuits.values()),
+                'bytes': num_bytes}
@@ -0,0 +1,109 @@
+"""
+    `scheduler.py`
+
+    Online ordering of the stages of the classification cascade.
+
+    `MiddleEarthModel.predict` stops at the first model that rejects a
+    circuit, so the expected cost of a prediction depends on the order of
+    the models. For independent stages with cost c_i and pass rate p_i, it
+    is minimized by sorting them by increasing c_i / (1 - p_i): cheap stages
+    that reject most circuits first.
+
+        model.set_scheduler(AdaptiveScheduler(len(model._models)))
+        ...
+        print(model._scheduler.report())
+
+    Stages are only reordered within groups, given by the model (see
+    `MiddleEarthModel.stage_groups`): runs of consecutive stages whose
+    confidence is always 1.0, for which the stage that rejects a circuit
+    does not change the output. Groups keep their pipeline order.
+
+    The costs and pass rates are exponentially-weighted moving averages,
+    measured on the live predictions, and the order is updated every
+    `reorder_every` predictions. The pass rates are those of the circuits
+    that reach a stage, i.e. conditional on passing the stages before it.
+"""
+
+
+class AdaptiveScheduler(object):
+    """Evaluation order of the stages of a `MiddleEarthModel`.
+
+    Parameters
+    ----------
+    num_stages : int
+        Number of models in the pipeline.
+    decay : float
+        Weight of a new measure in the moving averages.
+    warmup : int
+        Predictions measured before the order is first changed.
+    reorder_every : int
+        Predictions between two updates of the order.
+    groups : list of list of int
+        Stages that can be reordered among themselves, in pipeline order.
+        Defaults to a single group with all the stages.
+    """
+
+    def __init__(self, num_stages, decay=0.02, warmup=100, reorder_every=500, groups=None):
+        self.num_stages = num_stages
+        self.decay = decay
+        self.warmup = warmup
+        self.reorder_every = reorder_every
+        self.set_groups(groups if groups is not None else [list(range(num_stages))])
+
+        self.cost = [None] * num_stages
+        self.pass_rate = [None] * num_stages
+        self.evaluations = [0] * num_stages
+        self.predictions = 0
+        self.reorders = 0
+
+    def set_groups(self, groups):
+        """Set the groups of reorderable stages and restore the pipeline order."""
+        groups = [list(group) for group in groups]
+        if sorted(s for group in groups for s in group) != list(range(self.num_stages)):
+            raise ValueError("The groups must cover each of the {} stages once.".format(self.num_stages))
+        # config order until enough has been measured
+        self.group_orders = groups
+
+    @property
+    def order(self):
+        """All the stages, in evaluation order."""
+        return [s for group in self.group_orders for s in group]
+
+    def record(self, stage, seconds, passed):
+        """Record the evaluation of a stage on one circuit."""
+        passed = 1.0 if passed else 0.0
+        if self.cost[stage] is None:
+            self.cost[stage] = seconds
+            self.pass_rate[stage] = passed
+        else:
+            self.cost[stage] += self.decay * (seconds - self.cost[stage])
+            self.pass_rate[stage] += self.decay * (passed - self.pass_rate[stage])
+        self.evaluations[stage] += 1
+
+    def prediction_done(self):
+        """Count a prediction and update the order when it is due."""
+        self.predictions += 1
+        if self.predictions >= self.warmup and (self.predictions - self.warmup) % self.reorder_every == 0:
+            self.update_order()
+
+    def rank(self, stage):
+        """Expected cost per rejected circuit: the sort key of a stage."""
+        if self.cost[stage] is None:
+            # never measured: keep it where the config put it
+            return None
+        reject_rate = 1.0 - self.pass_rate[stage]
+        return self.cost[stage] / reject_rate if reject_rate > 0 else float('inf')
+
+    def update_order(self):
+        if any(c is None for c in self.cost):
+            return
+        group_orders = [sorted(group, key=lambda s: (self.rank(s), s)) for group in self.group_orders]
+        if group_orders != self.group_orders:
+            self.group_orders = group_orders
+            self.reorders += 1
+
+    def report(self):
+        """Stages in evaluation order, with their measures."""
+        return [{'stage': s, 'cost_seconds': self.cost[s], 'pass_rate': self.pass_rate[s],
+                 'rank': self.rank(s), 'evaluations': self.evaluations[s]}
+                for s in self.order]
@@ -0,0 +1,100 @@
+"""
+    `storage.py`
+
+    Pickle-free on-disk format for trained models.
+
+    A model is stored in a directory with a JSON manifest and one `.npy` file
+    per array:
+
+        model_dir/
+            manifest.json
+            0.forest.feature.npy
+            0.forest.threshold.npy
+            ...
+
+    The manifest lists the models of the pipeline in order, with the name of
+    their classifier, their dataset, the JSON parameters returned by the
+    classifier's `get_state` and the file of each of its arrays. Arrays are
+    loaded with `np.load(mmap_mode='r')` by default, so that processes
+    loading the same model share a single page-cached copy.
+"""
+import json
+import numpy as np
+
+from os import makedirs
+from os.path import join, isdir, isfile
+
+FORMAT_NAME = 'onionpop-model'
+FORMAT_VERSION = 1
+MANIFEST_FILE = 'manifest.json'
+
+
+def is_model_dir(path):
+    """Whether `path` is a model stored in this format."""
+    return isdir(path) and isfile(join(path, MANIFEST_FILE))
+
+
+def save(dirpath, entries):
+    """Store the models of a pipeline.
+
+    Parameters
+    ----------
+    dirpath : str
+        Directory where the model is stored. It is created if needed.
+    entries : list of dict
+        One dictionary per model with the keys `classifier` (class name),
+        `dataset`, `params` (JSON-serializable) and `arrays` (name -> array).
+    """
+    if not isdir(dirpath):
+        makedirs(dirpath)
+
+    manifest = {'format': FORMAT_NAME, 'version': FORMAT_VERSION, 'models': []}
+    for i, entry in enumerate(entries):
+        array_files = {}
+        for name, array in sorted(entry['arrays'].items()):
+            array_files[name] = "{}.{}.npy".format(i, name)
+            np.save(join(dirpath, array_files[name]), np.asarray(array), allow_pickle=False)
+        manifest['models'].append({'classifier': entry['classifier'],
+                                   'dataset': entry['dataset'],
+                                   'params': entry['params'],
+                                   'arrays': array_files})
+
+    with open(join(dirpath, MANIFEST_FILE), 'w') as fo:
+        json.dump(manifest, fo, indent=2, sort_keys=True)
+
+
+def _is_plain_filename(fname):
+    return (isinstance(fname, str) and fname not in ('', '.', '..') and
+            '/' not in fname and '\\' not in fname)
+
+
+def load(dirpath, mmap_mode='r'):
+    """Load the models stored by `save`.
+
+    Output
+    ------
+        entries : list of dict
+            Same structure as the `entries` passed to `save`, with the arrays
+            memory-mapped unless `mmap_mode` is None.
+    """
+    with open(join(dirpath, MANIFEST_FILE)) as fi:
+        manifest = json.load(fi)
+
+    if manifest.get('format') != FORMAT_NAME:
+        raise ValueError("{} is not an onionpop model.".format(dirpath))
+    if manifest.get('version') != FORMAT_VERSION:
+        raise ValueError("Unsupported model format version: {}".format(manifest.get('version')))
+
+    entries = []
+    for model in manifest['models']:
+        arrays = {}
+        for name, fname in model['arrays'].items():
+            # array files must be in the model directory
+            if not _is_plain_filename(fname):
+                raise ValueError("Invalid array file in the manifest: {!r}".format(fname))
+            arrays[name] = np.load(join(dirpath, fname), mmap_mode=mmap_mode, allow_pickle=False)
+        entries.append({'classifier': model['classifier'],
+                        'dataset': model['dataset'],
+                        'params': model['params'],
+                        'arrays': arrays})
+    return entries
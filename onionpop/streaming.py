@@ -0,0 +1,101 @@
+"""
+    `streaming.py`
+
+    Classifies circuits while their cells arrive, instead of at their end.
+
+        stream = StreamingClassifier(model, prefix_cells=50, on_result=report,
+                                     idle_timeout=60, max_cells=10 ** 7)
+        for cell in cells:
+            stream.add_cell(cell)
+        stream.close()
+
+    The first models of the pipeline (purpose and position) only need the
+    running cell counts, so they are run as soon as a circuit has
+    `prefix_cells` cells, on the features of that prefix (as given by
+    `Features.count_cells(limit=prefix_cells)`). Rejected circuits are
+    reported right away and their cells are freed; the following cells are
+    only counted. The remaining models (website) are run on the circuits that
+    passed, once they are finished, on their whole trace.
+
+    The models of the first stages should therefore be trained on the
+    features of the first `prefix_cells` cells of the training circuits.
+"""
+from onionpop.features import Features
+from onionpop.registry import CircuitRegistry
+
+
+class StreamingClassifier(object):
+    """Prefix classification of live circuits.
+
+    Parameters
+    ----------
+    model : onionpop.pipeline.MiddleEarthModel
+        Trained pipeline.
+    prefix_cells : int
+        Number of cells after which the first stages are run.
+    on_result : callable
+        Called as `on_result(circuit, prediction, confidence)` once per
+        circuit, with the same output as `MiddleEarthModel.predict`.
+    prefix_stages : int
+        Number of models of the pipeline run on the prefix. By default, all
+        but the last one.
+    registry_kwargs :
+        Passed to `onionpop.registry.CircuitRegistry` (budgets, timeout).
+    """
+
+    def __init__(self, model, prefix_cells, on_result=None, prefix_stages=None, **registry_kwargs):
+        self.model = model
+        self.prefix_cells = prefix_cells
+        self.on_result = on_result
+        self.prefix_stages = len(model._models) - 1 if prefix_stages is None else prefix_stages
+        self.registry = CircuitRegistry(on_finished=self._on_finished, **registry_kwargs)
+
+        # confidences of the live circuits that passed the prefix stages
+        self._candidates = {}
+        # live circuits already reported as rejected
+        self._rejected = set()
+        self.early_rejected = 0
+
+    def add_cell(self, cell):
+        key = (cell.chan_id, cell.circ_id)
+        self.registry.add_cell(cell)
+
+        circuit = self.registry.get(*key)
+        if circuit is not None and circuit.counter.num_cells == self.prefix_cells:
+            self._classify_prefix(key, circuit)
+
+    def close(self):
+        """Finish and classify all the live circuits."""
+        self.registry.close()
+
+    def memory_footprint(self):
+        return self.registry.memory_footprint()
+
+    def _classify_prefix(self, key, circuit):
+        is_detected, confidence = self.model.predict_stages(Features(circuit), 0, self.prefix_stages)
+        if is_detected:
+            self._candidates[key] = confidence
+        else:
+            # no need to keep the trace of a rejected circuit
+            self.registry.release_cells(circuit)
+            self._rejected.add(key)
+            self.early_rejected += 1
+            self._report(circuit, False, confidence)
+
+    def _on_finished(self, circuit, reason):
+        key = (circuit.chan_id, circuit.circ_id)
+        if key in self._rejected:
+            self._rejected.discard(key)
+            return
+
+        if key in self._candidates:
+            is_detected, confidence = self.model.predict_stages(
+                Features(circuit), self.prefix_stages, None, self._candidates.pop(key))
+        else:
+            # finished before reaching the prefix length
+            is_detected, confidence = self.model.predict(Features(circuit))
+        self._report(circuit, is_detected, confidence)
+
+    def _report(self, circuit, prediction, confidence):
+        if self.on_result is not None:
+            self.on_result(circuit, prediction, confidence)
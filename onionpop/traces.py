@@ -0,0 +1,159 @@
+"""
+    `traces.py`
+
+    Readers for the captured circuits and traces that training datasets are
+    built from (see `./pipeline.py features`).
+
+    Two input formats are supported:
+
+    - Circuit files (`.jsonl`), with one circuit per line:
+
+        {"label": 1, "id": "c-17", "chan_id": 3, "circ_id": 7,
+         "prev_node": {"is_relay": true, "is_guard": true, "is_exit": false},
+         "next_node": null,
+         "cells": [[1235.465052, "CREATE2", "UNKNOWN", false, false], ...]}
+
+      where every cell is `[timestamp, type, command, is_sent, is_outbound]`.
+      `id`, the nodes and their nicknames, IP addresses and fingerprints are
+      optional.
+
+    - k-FP trace files, with one "<timestamp>\t<direction>" line per cell
+      seen on the client side, named "<label>-<instance>" (e.g. "344-0"),
+      possibly grouped in a directory. They only carry what the website
+      features need.
+
+    The input is enumerated as items (a line or a file path) so that the
+    parsing itself can be spread over worker processes with `parse_item`.
+"""
+import json
+
+from os import listdir
+from os.path import isdir, basename, join
+
+from onionpop.features import Node, Cell, Circuit, CELL_TYPE_CODES, CELL_COMMAND_CODES
+
+CIRCUIT_FILE = 'circuit'
+TRACE_FILE = 'trace'
+
+_RELAY = CELL_TYPE_CODES['RELAY']
+_UNKNOWN_COMMAND = CELL_COMMAND_CODES['UNKNOWN']
+
+
+def iter_items(paths):
+    """Enumerate the circuits of the input paths, in a stable order.
+
+    Yields `(kind, payload, source)` where `payload` is a line of a circuit
+    file or the path of a trace file, and `source` identifies the circuit
+    ("<file>:<line>" or the trace path). Directories are read in sorted
+    order.
+    """
+    for path in paths:
+        if isdir(path):
+            for name in sorted(listdir(path)):
+                if not name.startswith('.'):
+                    for item in iter_items([join(path, name)]):
+                        yield item
+        elif path.endswith('.jsonl'):
+            with open(path) as fi:
+                for i, line in enumerate(fi):
+                    if line.strip():
+                        yield CIRCUIT_FILE, line, "{}:{}".format(path, i + 1)
+        else:
+            yield TRACE_FILE, path, path
+
+
+def parse_item(kind, payload, content=None):
+    """Return the `(label, circuit_id, Circuit)` of an item of `iter_items`.
+
+    `content` is the `item_content` of the item, if already read.
+    """
+    if kind == CIRCUIT_FILE:
+        return parse_circuit(json.loads(payload))
+    if content is None:
+        content = item_content(kind, payload)
+    label, name = item_label(kind, payload)
+    return label, name, parse_trace_lines(content.decode('utf-8').splitlines())
+
+
+def item_content(kind, payload):
+    """Bytes an item is parsed from: the line of a circuit file or the
+    content of a trace file.
+    """
+    if kind == CIRCUIT_FILE:
+        return payload.encode('utf-8')
+    with open(payload, 'rb') as fi:
+        return fi.read()
+
+
+def item_label(kind, payload, content=None):
+    """Return the `(label, circuit_id)` of an item without parsing its cells."""
+    if kind == CIRCUIT_FILE:
+        record = json.loads(content if content is not None else payload)
+        return record.get('label'), _circuit_id(record)
+    name = basename(payload)
+    return _parse_label(name.split('-', 1)[0]), name
+
+
+def parse_circuit(record):
+    """Return the `(label, circuit_id, Circuit)` of a circuit file record."""
+    chan_id = record.get('chan_id', 0)
+    circ_id = record.get('circ_id', 0)
+    circuit = Circuit(chan_id, circ_id, _parse_node(record.get('prev_node')),
+                      _parse_node(record.get('next_node')))
+    for timestamp, cell_type, cell_command, is_sent, is_outbound in record['cells']:
+        circuit.add_cell(Cell(chan_id, circ_id, float(timestamp), cell_type, cell_command,
+                              bool(is_sent), bool(is_outbound)))
+    return record.get('label'), _circuit_id(record), circuit
+
+
+def parse_trace_lines(lines):
+    """Build the client side of a circuit from k-FP trace lines.
+
+    Outgoing cells (positive direction) are received from the client, and
+    incoming cells are sent to it, as in `Features.get_cell_arrays`.
+    """
+    circuit = Circuit(0, 0, None, None)
+    for line in lines:
+        fields = line.strip().split('\t')
+        if len(fields) < 2 or fields[1] == 'None':
+            continue
+        is_sent = float(fields[1]) <= 0
+        circuit.append(float(fields[0]), _RELAY, _UNKNOWN_COMMAND, is_sent, False)
+    return circuit
+
+
+def circuit_record(circuit, label=None, circuit_id=None):
+    """Inverse of `parse_circuit`: the circuit file record of a circuit."""
+    def node(n):
+        if n is None:
+            return None
+        return {'nickname': n.nickname, 'ip_address': n.ip_address, 'fingerprint': n.fingerprint,
+                'is_relay': n.is_relay, 'is_exit': n.is_exit, 'is_guard': n.is_guard}
+
+    record = {'label': label, 'chan_id': circuit.chan_id, 'circ_id': circuit.circ_id,
+              'prev_node': node(circuit.prev_node), 'next_node': node(circuit.next_node),
+              'cells': [[c.timestamp, c.ctype, c.command, bool(c.is_sent), bool(c.is_outbound)]
+                        for c in circuit.cells]}
+    if circuit_id is not None:
+        record['id'] = circuit_id
+    return record
+
+
+def _circuit_id(record):
+    return record.get('id', "{}.{}".format(record.get('chan_id', 0), record.get('circ_id', 0)))
+
+
+def _parse_node(record):
+    if record is None:
+        return None
+    return Node(record.get('nickname'), record.get('ip_address'), record.get('fingerprint'),
+                bool(record.get('is_relay')), bool(record.get('is_exit')), bool(record.get('is_guard')))
+
+
+def _parse_label(text):
+    for convert in (int, float):
+        try:
+            return convert(text)
+        except ValueError:
+            pass
+    return text
@@ -0,0 +1,310 @@
+"""
+    `worker.py`
+
+    Runs the predictions of a `MiddleEarthModel` off the caller's thread, so
+    that an event loop handling cell events never blocks on a classifier.
+
+        worker = ClassificationWorker(model, max_workers=2, max_pending=1000)
+        future = worker.submit(features)            # concurrent.futures.Future
+        prediction, confidence = future.result()
+
+        # from an asyncio coroutine
+        prediction, confidence = await worker.submit_async(features)
+
+        worker.close()                              # waits for the pending ones
+
+    At most `max_pending` predictions can be queued or running. Beyond that,
+    `submit` raises `QueueFull` (or blocks, with `block=True`), and
+    `on_backpressure(True)` is called so that the caller can stop reading
+    events; `on_backpressure(False)` is called once the backlog is down to
+    `low_watermark`.
+
+    With `processes=True` the predictions run in worker processes, which
+    load the model themselves. Give the path of a model saved with
+    `MiddleEarthModel.save` so that they share its memory-mapped arrays.
+
+    `ShardedPredictor` spreads batches of circuits over one process per
+    shard, by `(chan_id, circ_id)`:
+
+        with ShardedPredictor('model_dir', num_shards=8) as predictor:
+            predictions, confidences = predictor.predict_many(features_list)
+"""
+import shutil
+import itertools
+import tempfile
+import threading
+import numpy as np
+
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+# model of a worker process, see `_init_process`
+_process_model = None
+
+
+def _init_process(model_path):
+    global _process_model
+    from onionpop.pipeline import MiddleEarthModel
+    _process_model = MiddleEarthModel.load(model_path)
+
+
+def _predict_in_process(features):
+    return _process_model.predict(features)
+
+
+def _predict_many_in_process(features_list):
+    return _process_model.predict_many(features_list)
+
+
+class QueueFull(Exception):
+    """Raised by `ClassificationWorker.submit` when `max_pending` predictions
+    are already queued or running.
+    """
+    pass
+
+
+class ClassificationWorker(object):
+    """Pool of threads or processes running `MiddleEarthModel.predict`.
+
+    Parameters
+    ----------
+    model : onionpop.pipeline.MiddleEarthModel or str
+        Trained model, or path to a saved model (required with `processes`).
+    max_workers : int
+        Number of threads or processes.
+    max_pending : int
+        Maximum number of queued or running predictions.
+    processes : bool
+        Predict in worker processes instead of threads.
+    low_watermark : int
+        Backlog under which the backpressure is released. Defaults to half
+        of `max_pending`.
+    on_backpressure : callable
+        Called as `on_backpressure(True)` when the queue becomes full and
+        `on_backpressure(False)` when it is back to `low_watermark`. It may
+        be called from a worker thread.
+    """
+
+    def __init__(self, model, max_workers=1, max_pending=1024, processes=False,
+                 low_watermark=None, on_backpressure=None):
+        if isinstance(model, str):
+            if not processes:
+                from onionpop.pipeline import MiddleEarthModel
+                model = MiddleEarthModel.load(model)
+        elif processes:
+            raise ValueError("Worker processes need the path of a saved model.")
+
+        self.model = model
+        self.max_pending = max_pending
+        self.low_watermark = max_pending // 2 if low_watermark is None else low_watermark
+        self.on_backpressure = on_backpressure
+
+        if processes:
+            self._executor = ProcessPoolExecutor(max_workers, initializer=_init_process, initargs=(model,))
+            self._predict = _predict_in_process
+        else:
+            self._executor = ThreadPoolExecutor(max_workers)
+            self._predict = model.predict
+
+        self._cond = threading.Condition()
+        self._futures = set()
+        self._closed = False
+        self.saturated = False
+        self.submitted = 0
+        self.completed = 0
+        self.rejected = 0
+
+    @property
+    def pending(self):
+        """Number of queued or running predictions."""
+        return len(self._futures)
+
+    def submit(self, features, block=False, timeout=None):
+        """Schedule the prediction of a circuit.
+
+        Parameters
+        ----------
+        features : onionpop.features.Features
+        block : bool
+            Wait for a free slot instead of raising `QueueFull`.
+        timeout : float
+            Maximum wait with `block`, in seconds.
+
+        Output
+        ------
+            future : concurrent.futures.Future
+                Resolves to the `(prediction, confidence)` of `predict`.
+        """
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("The worker is closed.")
+            if len(self._futures) >= self.max_pending:
+                if block:
+                    self._cond.wait_for(lambda: self._closed or len(self._futures) < self.max_pending,
+                                        timeout)
+                    if self._closed:
+                        raise RuntimeError("The worker is closed.")
+                if len(self._futures) >= self.max_pending:
+                    self.rejected += 1
+                    raise QueueFull("{} predictions pending.".format(len(self._futures)))
+
+            future = self._executor.submit(self._predict, features)
+            self._futures.add(future)
+            self.submitted += 1
+            signal = not self.saturated and len(self._futures) >= self.max_pending
+            if signal:
+                self.saturated = True
+
+        if signal and self.on_backpressure is not None:
+            self.on_backpressure(True)
+        future.add_done_callback(self._on_done)
+        return future
+
+    def submit_async(self, features, loop=None):
+        """`submit` for asyncio: return an awaitable `asyncio.Future`.
+
+        Must be called from the thread of the event loop.
+        """
+        import asyncio
+        return asyncio.wrap_future(self.submit(features), loop=loop)
+
+    def _on_done(self, future):
+        with self._cond:
+            if future not in self._futures:
+                return
+            self._futures.discard(future)
+            self.completed += 1
+            signal = self.saturated and len(self._futures) <= self.low_watermark
+            if signal:
+                self.saturated = False
+            self._cond.notify_all()
+
+        if signal and self.on_backpressure is not None:
+            self.on_backpressure(False)
+
+    def close(self, drain=True, timeout=None):
+        """Stop accepting predictions and shut the pool down.
+
+        Parameters
+        ----------
+        drain : bool
+            Wait for the pending predictions. Otherwise, the ones that have
+            not started yet are cancelled.
+        timeout : float
+            Maximum wait for the pending predictions, in seconds; the ones
+            still queued after it are cancelled.
+
+        Output
+        ------
+            drained : bool
+                Whether all the pending predictions completed.
+        """
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+            if drain:
+                self._cond.wait_for(lambda: not self._futures, timeout)
+            futures = list(self._futures)
+
+        for future in futures:
+            future.cancel()
+        self._executor.shutdown(wait=True)
+        return not futures
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class ShardedPredictor(object):
+    """Batch predictions spread over worker processes.
+
+    Every circuit goes to the shard `hash((chan_id, circ_id)) % num_shards`,
+    served by its own process, and the results are put back in the order of
+    the input. The processes load the model with memory-mapped arrays (see
+    `onionpop.storage`), so a single copy is held in the page cache.
+
+    Parameters
+    ----------
+    model : onionpop.pipeline.MiddleEarthModel or str
+        Trained model, or path to a model saved with `MiddleEarthModel.save`.
+        A model object is saved to a temporary directory, removed by `close`.
+    num_shards : int
+        Number of worker processes.
+    """
+
+    def __init__(self, model, num_shards=2):
+        self._tmp_dir = None
+        if not isinstance(model, str):
+            self._tmp_dir = tempfile.mkdtemp(prefix='onionpop-model-')
+            model.save(self._tmp_dir)
+            model = self._tmp_dir
+
+        self.num_shards = num_shards
+        self._executors = [ProcessPoolExecutor(1, initializer=_init_process, initargs=(model,))
+                           for _ in range(num_shards)]
+
+    def shard(self, features):
+        """Shard of a circuit."""
+        circuit = features.circuit
+        return hash((circuit.chan_id, circuit.circ_id)) % self.num_shards
+
+    def predict_many(self, features_list):
+        """Same output as `MiddleEarthModel.predict_many`."""
+        return self.submit_many(features_list)()
+
+    def submit_many(self, features_list):
+        """Send a batch to the shards without waiting for the results.
+
+        Output
+        ------
+            result : callable
+                Waits for the batch and returns the output of `predict_many`.
+        """
+        shard_idx = [[] for _ in range(self.num_shards)]
+        for i, features in enumerate(features_list):
+            shard_idx[self.shard(features)].append(i)
+
+        futures = []
+        for shard, idx in enumerate(shard_idx):
+            if idx:
+                futures.append((idx, self._executors[shard].submit(
+                    _predict_many_in_process, [features_list[i] for i in idx])))
+
+        def result():
+            predictions = np.ones(len(features_list), dtype=bool)
+            confidences = np.ones(len(features_list))
+            for idx, future in futures:
+                predictions[idx], confidences[idx] = future.result()
+            return predictions, confidences
+        return result
+
+    def imap(self, features_iter, batch_size=256):
+        """Yield `(prediction, confidence)` for every circuit of an iterable,
+        in order, keeping one batch in flight while the previous one is read.
+        """
+        features_iter = iter(features_iter)
+        pending = None
+        while True:
+            batch = list(itertools.islice(features_iter, batch_size))
+            submitted = self.submit_many(batch) if batch else None
+            if pending is not None:
+                for item in zip(*pending()):
+                    yield item
+            if submitted is None:
+                break
+            pending = submitted
+
+    def close(self):
+        for executor in self._executors:
+            executor.shutdown(wait=True)
+        if self._tmp_dir is not None:
+            shutil.rmtree(self._tmp_dir, ignore_errors=True)
+            self._tmp_dir = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -0,0 +1,121 @@
+"""
+    `test_cumul.py`
+
+    Equivalence of the vectorized CUMUL extractor with the original,
+    list-based one on traces like those of `data/cumul_training.libsvm`.
+"""
+import numpy as np
+
+from itertools import islice
+from os.path import join, dirname
+
+from onionpop import cumul
+
+DATA_DIR = join(dirname(__file__), 'data')
+
+
+def reference_extract(instance, num_interpolation_points=100):
+    """Original `cumul.extract`, before vectorization."""
+    features = []
+
+    total = []
+    cum = []
+    inSize = 0
+    outSize = 0
+    inCount = 0
+    outCount = 0
+
+    for _, packetsize in instance:
+        # incoming packets
+        if packetsize > 0:
+            inSize += packetsize
+            inCount += 1
+            if len(cum) == 0:
+                cum.append(packetsize)
+                total.append(packetsize)
+            else:
+                cum.append(cum[-1] + packetsize)
+                total.append(total[-1] + abs(packetsize))
+
+        # outgoing packets
+        if packetsize < 0:
+            outSize += abs(packetsize)
+            outCount += 1
+            if len(cum) == 0:
+                cum.append(packetsize)
+                total.append(abs(packetsize))
+            else:
+                cum.append(cum[-1] + packetsize)
+                total.append(total[-1] + abs(packetsize))
+
+    features.append(inCount)
+    features.append(outCount)
+    features.append(outSize)
+    features.append(inSize)
+
+    cumFeatures = np.interp(np.linspace(total[0], total[-1], num_interpolation_points + 1), total, cum)
+    for el in islice(cumFeatures, 1, None):
+        features.append(el)
+
+    return features
+
+
+def _training_counts(limit=50):
+    """(incoming, outgoing) cell counts of the training traces."""
+    counts = []
+    with open(join(DATA_DIR, 'cumul_training.libsvm')) as fi:
+        for line in islice(fi, limit):
+            fields = dict(token.split(':') for token in line.split()[1:3])
+            counts.append((int(float(fields['0'])), int(float(fields['1']))))
+    return counts
+
+
+def _traces(seed=0):
+    """+-1 cell traces with the counts of the training data, and traces of
+    signed packet sizes with padding zeros.
+    """
+    rng = np.random.RandomState(seed)
+    traces = []
+    for num_in, num_out in _training_counts():
+        sizes = np.concatenate((np.ones(num_in, dtype=int), -np.ones(num_out, dtype=int)))
+        rng.shuffle(sizes)
+        traces.append(sizes)
+    for _ in range(50):
+        length = rng.randint(1, 3000)
+        sizes = rng.randint(1, 1515, size=length) * rng.choice([-1, 1, 0], size=length, p=[0.45, 0.45, 0.1])
+        sizes[rng.randint(length)] = rng.choice([-1, 1]) * rng.randint(1, 1515)
+        traces.append(sizes)
+    # a single packet and a single direction
+    traces.append(np.array([-1]))
+    traces.append(np.array([512, 512, 0, 1500]))
+    return traces
+
+
+def _instance(sizes):
+    return [(0.01 * i, int(size)) for i, size in enumerate(sizes)]
+
+
+def test_extract():
+    for sizes in _traces():
+        instance = _instance(sizes)
+        expected = reference_extract(instance)
+        np.testing.assert_array_equal(cumul.extract(instance), expected)
+        np.testing.assert_array_equal(cumul.extract(np.array(instance)), expected)
+
+
+def test_extract_sizes():
+    for sizes in _traces(seed=1):
+        np.testing.assert_array_equal(cumul.extract_sizes(sizes), reference_extract(_instance(sizes)))
+
+
+def test_extract_many():
+    traces = _traces(seed=2)
+    instances = [_instance(sizes) for sizes in traces]
+    expected = np.array([reference_extract(instance) for instance in instances])
+    np.testing.assert_array_equal(cumul.extract_many(instances), expected)
+    np.testing.assert_array_equal(cumul.extract_sizes_many(traces), expected)
+
+
+def test_interpolation_points():
+    sizes = _traces(seed=3)[0]
+    np.testing.assert_array_equal(cumul.extract_sizes(sizes, 20), reference_extract(_instance(sizes), 20))
@@ -0,0 +1,63 @@
+"""
+    `test_forest.py`
+
+    Flattened forests must predict exactly like the scikit-learn forests
+    they come from.
+"""
+import numpy as np
+
+from sklearn.ensemble import RandomForestClassifier
+
+from onionpop.forest import FlatForest
+from onionpop.storage import save, load
+
+
+def _data(seed, num_samples=400, num_features=12, num_classes=2):
+    rng = np.random.RandomState(seed)
+    X = rng.normal(size=(num_samples, num_features))
+    # count-like columns, as in the purpose and position features
+    X[:, :4] = rng.poisson(3, size=(num_samples, 4))
+    y = (X[:, 0] + X[:, 5] + rng.normal(size=num_samples) > 3).astype(int)
+    if num_classes > 2:
+        y += (X[:, 6] > 0).astype(int) * (num_classes - 2)
+    return X, y
+
+
+def _assert_same(estimator, forest, X):
+    np.testing.assert_array_equal(forest.predict(X), estimator.predict(X))
+    np.testing.assert_array_equal(forest.predict_proba(X), estimator.predict_proba(X))
+
+
+def test_binary():
+    X, y = _data(0)
+    estimator = RandomForestClassifier(n_estimators=20, random_state=0).fit(X, y)
+    forest = FlatForest.from_estimator(estimator)
+    _assert_same(estimator, forest, _data(1)[0])
+    # samples exactly on the split thresholds
+    _assert_same(estimator, forest, X)
+
+
+def test_multiclass_and_labels():
+    X, y = _data(2, num_classes=3)
+    labels = np.array([3, 7, 11])[y]
+    estimator = RandomForestClassifier(n_estimators=15, max_depth=6, random_state=1).fit(X, labels)
+    forest = FlatForest.from_estimator(estimator)
+    _assert_same(estimator, forest, _data(3)[0])
+
+
+def test_single_sample():
+    X, y = _data(4)
+    estimator = RandomForestClassifier(n_estimators=5, random_state=2).fit(X, y)
+    forest = FlatForest.from_estimator(estimator)
+    for x in _data(5, num_samples=20)[0]:
+        np.testing.assert_array_equal(forest.predict(x), estimator.predict(x.reshape(1, -1)))
+
+
+def test_stored_forest(tmp_path):
+    X, y = _data(6)
+    estimator = RandomForestClassifier(n_estimators=10, random_state=3).fit(X, y)
+    params, arrays = FlatForest.from_estimator(estimator).get_state()
+    save(str(tmp_path), [{'classifier': 'FlatForest', 'dataset': None, 'params': params, 'arrays': arrays}])
+    entry = load(str(tmp_path))[0]
+    forest = FlatForest.from_state(entry['params'], entry['arrays'])
+    _assert_same(estimator, forest, _data(7)[0])
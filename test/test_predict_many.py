@@ -0,0 +1,75 @@
+"""
+    `test_predict_many.py`
+
+    `predict_many` must give exactly the outputs of `predict` on every
+    circuit, for each classifier and for the whole pipeline.
+"""
+import numpy as np
+
+from onionpop.features import Features, Circuit, CELL_TYPE_KEYS, CELL_COMMAND_KEYS
+from onionpop.pipeline import Model, MiddleEarthModel
+
+
+def _random_circuit(rng, i):
+    circuit = Circuit(0, i, None, None)
+    timestamp = 0.0
+    for _ in range(rng.randint(5, 120)):
+        timestamp += rng.exponential(0.05)
+        circuit.append(timestamp, rng.randint(len(CELL_TYPE_KEYS)), rng.randint(len(CELL_COMMAND_KEYS)),
+                       rng.rand() < 0.5, rng.rand() < 0.5)
+    # at least one client-side cell, for the website features
+    circuit.append(timestamp + 0.01, 0, 0, True, False)
+    return circuit
+
+
+def _features(num_circuits=120, seed=0):
+    rng = np.random.RandomState(seed)
+    return [Features(_random_circuit(rng, i)) for i in range(num_circuits)]
+
+
+def _train(classifier, params, extract, features, seed):
+    labels = np.random.RandomState(seed).randint(2, size=len(features))
+    model = Model({'dataset': None, 'classifier': classifier, 'params': params})
+    model._clf.train(np.array([extract(f) for f in features], dtype=float), labels)
+    return model
+
+
+def _pipeline(features):
+    model = MiddleEarthModel()
+    forest_params = {'backend': 'sklearn', 'n_estimators': 10, 'random_state': 0}
+    model.add(_train('PurposeClassifier', forest_params, Features.extract_purpose_features, features, 1))
+    model.add(_train('PositionClassifier', forest_params, Features.extract_position_features, features, 2))
+    model.add(_train('OneClassCUMUL', {'kernel': 'rbf', 'gamma': 0.5}, Features.extract_webfp_features,
+                     features, 3))
+    model.add(_train('KFPClassifier', {'n_estimators': 10, 'random_state': 0},
+                     Features.extract_kfp_features, features, 4))
+    return model
+
+
+def _assert_same(predictor, features):
+    single = [predictor.predict(f) for f in features]
+    predictions, confidences = predictor.predict_many(features)
+    np.testing.assert_array_equal(predictions, [p for p, _ in single])
+    np.testing.assert_array_equal(confidences, [c for _, c in single])
+
+
+def test_classifiers():
+    features = _features()
+    for model in _pipeline(features)._models:
+        _assert_same(model._clf, _features(seed=1))
+
+
+def test_pipeline():
+    features = _features()
+    model = _pipeline(features)
+    test_features = _features(seed=1)
+    _assert_same(model, test_features)
+    # some circuits go through the whole pipeline, some are rejected early
+    predictions, _ = model.predict_many(test_features)
+    assert 0 < predictions.sum() < len(predictions)
+
+
+def test_empty_batch():
+    model = _pipeline(_features())
+    predictions, confidences = model.predict_many([])
+    assert len(predictions) == 0 and len(confidences) == 0
@@ -0,0 +1,103 @@
+"""
+    `test_scheduler.py`
+
+    Adaptive stage ordering must give the outputs of the pipeline order,
+    while evaluating fewer stages when a cheap stage rejects most circuits.
+"""
+import pytest
+
+from onionpop.classifiers import ClassifierInterface
+from onionpop.pipeline import Model, MiddleEarthModel
+from onionpop.scheduler import AdaptiveScheduler
+
+
+class _Circuit(object):
+
+    def __init__(self, is_hs, is_middle, client_cells):
+        self.is_hs = is_hs
+        self.is_middle = is_middle
+        self.client_cells = client_cells
+
+
+class _Stage(ClassifierInterface):
+    """Accepts the circuits for which `attribute` is true."""
+
+    def __init__(self, attribute, confidence=1.0, reorderable=True):
+        self.attribute = attribute
+        self.confidence = confidence
+        self.reorderable = reorderable
+        self.calls = 0
+        self._clf = self
+
+    def extract_features(self, features):
+        self.calls += 1
+        if not getattr(features, self.attribute) and self.attribute == 'client_cells':
+            # like the CUMUL and k-FP features
+            raise IndexError("no client-side cells")
+        return [float(getattr(features, self.attribute))]
+
+    def predict_with_confidence(self, feature_vector):
+        return feature_vector[0] > 0, self.confidence
+
+
+def _model(stages):
+    model = MiddleEarthModel()
+    for clf in stages:
+        stage = Model.__new__(Model)
+        stage._clf = clf
+        model.add(stage)
+    return model
+
+
+def _circuits(num_circuits=1000):
+    # 80% are not middle, 60% are HS and all have client-side cells
+    return [_Circuit(i % 5 < 3, i % 5 == 0, 5) for i in range(num_circuits)]
+
+
+def test_stage_groups():
+    model = _model([_Stage('is_hs'), _Stage('is_middle'), _Stage('client_cells', 0.7, reorderable=False),
+                    _Stage('is_hs'), _Stage('is_middle', reorderable=False), _Stage('is_hs')])
+    assert model.stage_groups() == [[0, 1], [2], [3], [4], [5]]
+
+
+def test_fewer_evaluations():
+    circuits = _circuits()
+    stages = [_Stage('is_hs'), _Stage('is_middle'), _Stage('client_cells', 0.7, reorderable=False)]
+    model = _model(stages)
+    expected = [model.predict(c) for c in circuits]
+    config_calls = [s.calls for s in stages]
+
+    for s in stages:
+        s.calls = 0
+    model.set_scheduler(AdaptiveScheduler(3, warmup=20, reorder_every=20))
+    assert [model.predict(c) for c in circuits] == expected
+    assert model._scheduler.order == [1, 0, 2]
+    # position rejects most circuits: purpose is evaluated on far fewer
+    assert stages[0].calls < config_calls[0] // 2
+    assert sum(s.calls for s in stages) < sum(config_calls)
+
+
+def test_confidence_stage_keeps_its_position():
+    circuits = _circuits()
+    # a cheap stage that rejects 80% but has a confidence: it must not move
+    stages = [_Stage('is_hs', 0.9, reorderable=False), _Stage('is_middle', 0.8, reorderable=False)]
+    model = _model(stages)
+    expected = [model.predict(c) for c in circuits]
+    model.set_scheduler(AdaptiveScheduler(2, warmup=20, reorder_every=20))
+    assert [model.predict(c) for c in circuits] == expected
+    assert model._scheduler.order == [0, 1]
+
+
+def test_failing_stage_falls_back_to_pipeline_order():
+    model = _model([_Stage('is_hs'), _Stage('client_cells')])
+    expected = [model.predict(_Circuit(False, False, 0)), model.predict(_Circuit(True, True, 5))]
+
+    scheduler = AdaptiveScheduler(2)
+    model.set_scheduler(scheduler)
+    scheduler.group_orders = [[1, 0]]
+    # rejected by purpose, never reaches the failing stage in pipeline order
+    assert model.predict(_Circuit(False, False, 0)) == expected[0]
+    assert model.predict(_Circuit(True, True, 5)) == expected[1]
+    # the pipeline order raises too
+    with pytest.raises(IndexError):
+        model.predict(_Circuit(True, True, 0))